@@ -23,6 +23,6 @@ setuptools.setup(
     ],
     keywords=["tensor networks"],
     install_requires=["scipy>=1.0.0", "pyyaml", "abeliantensors", "ncon"],
-    python_requires=">=3.6",
+    python_requires=">=3.7",
     package_data={"tntools": ["logging_default.conf"]},
 )
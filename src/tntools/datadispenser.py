@@ -64,11 +64,53 @@ the data that is generated and stored, or fetched.
 
 A user of datadispenser would call the function get_data. It has the following
 signature:
-get_data(db, dataname, pars, return_pars=False, **kwargs)
+get_data(db, dataname, pars, return_pars=False, lazy=False, max_workers=None,
+         **kwargs)
 The first argument is a path to a database, i.e., a folder in which the data is
-kept. return_pars specifies whether, with the data, the final pars that has
-been updated with default values, is to be returned. **kwargs can be used to
-provide values that override those in pars.
+kept, or a storage backend object, such as a pact.Pact or one of the backends
+in pactbackends.py. return_pars specifies whether, with the data, the final
+pars that has been updated with default values, is to be returned. lazy
+specifies whether data found on the disk should be loaded lazily, so that only
+the parts of it that are accessed are read (see Pact.fetch). If max_workers is
+not None and the data needs to be generated, all the prerequisites that need to
+be generated are found first, and generated in parallel by a pool of
+max_workers processes, each one as soon as its own prerequisites are done, see
+generate_parallel.
+**kwargs can be used to provide values that override those in pars.
+
+When several processes need the same data at the same time, only the first
+one generates it, and the others wait for it to be stored. This is done
+with lease files in the db folder, see claim.
+
+Storing every iteration of a long chain of iterations can take a lot of
+space. The dictionary storage_policies can be used to only keep some of the
+iterations of a given dataname, for instance
+storage_policies["A"] = keep_every(10)
+Gaps are then filled by generating forward from the nearest iteration that
+was kept. See also keep_ladder and keep_last.
+
+Before getting anything, get_data resolves the defaults, the idpars and the
+setup modules of the data and all its prerequisites once, into a Plan (see
+make_plan), which is then executed. The time spent planning is logged
+separately from the time spent generating. Neither recurses through the
+prerequisites, so long chains of iterations, where the data at iter_count n
+needs the data at n-1, are fine. For such chains, the stored iterations are
+found with one query to the index, and the chain is run forward from the
+highest one.
+
+To avoid reading the same data from the disk again and again in a
+long-running process, set pact.Pact.cache to a pact.FetchCache, for instance
+Pact.cache = FetchCache(2**30) for a cache of up to 1 GB.
+
+Storing generated data can be left to a background thread, so that the next
+computation can start while the data is being written, by calling
+enable_write_behind(maxsize=2)
+Then at most maxsize pieces of data are waiting to be written at any time,
+beyond which storing blocks until there's room. Data waiting to be written is
+returned by get_data as if it were already stored, so it must not be modified
+in-place meanwhile. wait_for_writes() waits until everything has been
+written, and raises any error that writing raised. It's also called when the
+Python process exits.
 
 A user may also want to call the function
 update_default_pars(dataname, pars, **kwargs)
@@ -82,12 +124,18 @@ integration with the initialtensors.py and initialtensors_setup.py
 modules is hardcoded.
 """
 
+import atexit
+import concurrent.futures
 import importlib
 import logging
 import configparser
 import os
+import queue
+import socket
+import threading
+import time
 from . import multilineformatter
-from .pact import Pact
+from .pact import Pact, PactBackend, CorruptEntryError, Range, lock_file
 
 
 # A dictionary that maps each dataname to a function that takes in pars, and
@@ -120,6 +168,57 @@ setupmodule_dict = {
 }
 
 
+# A dictionary that maps a dataname to a storage policy for chains of
+# iterations of it, i.e. data with iter_count among its idpars. A policy is a
+# function keep(iter_count, highest), that tells whether the iteration
+# iter_count should be stored, when the highest iteration of the chain that
+# is being generated is highest. Iterations that aren't kept are generated
+# again from the nearest one that is, when needed. store_data still applies
+# on top of this, and data with no policy is always stored. See keep_every,
+# keep_ladder and keep_last.
+storage_policies = {}
+
+
+def keep_every(k):
+    """ A storage policy that keeps every k-th iteration. """
+    if k < 1:
+        raise ValueError("keep_every needs k >= 1, got {}.".format(k))
+
+    def keep(iter_count, highest):
+        return iter_count % k == 0
+
+    return keep
+
+
+def keep_ladder(base=2):
+    """ A storage policy that keeps the iterations 1, base, base**2, ... """
+    if base < 2:
+        msg = "keep_ladder needs base >= 2, got {}.".format(base)
+        raise ValueError(msg)
+
+    def keep(iter_count, highest):
+        n = 1
+        while n < iter_count:
+            n *= base
+        return n == iter_count
+
+    return keep
+
+
+def keep_last(m):
+    """ A storage policy that keeps only the last m iterations generated.
+    Earlier iterations of the chain are deleted after generating it, see
+    prune_chains.
+    """
+    if m < 1:
+        raise ValueError("keep_last needs m >= 1, got {}.".format(m))
+
+    def keep(iter_count, highest):
+        return iter_count > highest - m
+
+    return keep
+
+
 # Always include a parameter called "store_data", that defaults to True.
 parinfo = {
     "store_data": {"default": True},
@@ -133,17 +232,33 @@ def apply_parinfo_defaults(pars, parinfo):
     return
 
 
-def get_data(db, dataname, pars, return_pars=False, **kwargs):
+def get_data(
+    db,
+    dataname,
+    pars,
+    return_pars=False,
+    lazy=False,
+    max_workers=None,
+    **kwargs
+):
     """ Get data from the disk if possible, if not, generate it. """
-    pars = copy_update(pars, **kwargs)
-    apply_parinfo_defaults(pars, parinfo)
-    update_default_pars(dataname, pars)
-    idpars = get_idpars(dataname, pars)
-    p = Pact(db)
-    if p.exists(dataname, idpars):
-        data = p.fetch(dataname, idpars)
-    else:
-        data = generate_data(dataname, pars, db=db)
+    p = open_db(db)
+    plan = make_plan(p, dataname, pars, **kwargs)
+    pars = plan.pars
+    # Checking just this entry is cheaper than querying its whole chain of
+    # iterations, which is only worth it if something needs generating.
+    found, data = fetch_plan(db, p, plan, lazy=lazy)
+    if not found:
+        start = time.time()
+        if max_workers is not None:
+            data = generate_parallel(db, dataname, pars, max_workers, plan)
+        else:
+            data = generate_plan(db, p, plan)
+        prune_chains(p, plan)
+        msg = "Generated {} in {:.3g} s, after planning for {:.3g} s."
+        logging.info(
+            msg.format(dataname, time.time() - start, plan.planning_time)
+        )
     retval = (data,)
     if return_pars:
         retval += (pars,)
@@ -152,6 +267,641 @@ def get_data(db, dataname, pars, return_pars=False, **kwargs):
     return retval
 
 
+class Plan:
+    """ A piece of data to get, with everything about it resolved once:
+    The dataname, the pars updated with the default values, the idpars, the
+    name of the setup module, the key of the idpars in the backend (None if
+    there's no backend), and the plans for the prerequisites, in the order
+    of prereq_pairs. Plans for the same data are shared, so the plans form
+    a directed acyclic graph. prereqs is None for a plan that only refers to
+    data that is already stored, see pruned. store tells whether the data
+    should be stored, which by default is pars["store_data"], and which
+    make_plan updates according to storage_policies.
+    """
+
+    def __init__(
+        self, dataname, pars, idpars, setupmod_name, key, prereqs, store=None
+    ):
+        self.dataname = dataname
+        self.pars = pars
+        self.idpars = idpars
+        self.setupmod_name = setupmod_name
+        self.key = key
+        self.prereqs = prereqs
+        self.store = pars["store_data"] if store is None else store
+        # Set by make_plan for the plan it returns.
+        self.planning_time = None
+
+    @property
+    def setupmod(self):
+        return importlib.import_module(self.setupmod_name)
+
+    def pruned(self):
+        """ Return a copy of the plan where the prerequisites that are
+        stored, and thus can be fetched, don't have prereqs of their own.
+        That's all the worker generating it needs, see run_dag.
+        """
+
+        def children(item):
+            plan = item[1]
+            return [(id(pre), pre) for pre in plan.prereqs if not pre.store]
+
+        def finish(item, kids, results):
+            plan = item[1]
+            pruned = dict(zip((kid[0] for kid in kids), results))
+            prereqs = [
+                pruned[id(pre)]
+                if not pre.store
+                else Plan(
+                    pre.dataname,
+                    pre.pars,
+                    pre.idpars,
+                    pre.setupmod_name,
+                    pre.key,
+                    None,
+                    pre.store,
+                )
+                for pre in plan.prereqs
+            ]
+            return Plan(
+                plan.dataname,
+                plan.pars,
+                plan.idpars,
+                plan.setupmod_name,
+                plan.key,
+                prereqs,
+                plan.store,
+            )
+
+        return evaluate((id(self), self), children, finish, dict())
+
+    def nodes(self):
+        """ Return the list of all the plans in this one, every one once. """
+        nodes = {id(self): self}
+        stack = [self]
+        while stack:
+            plan = stack.pop()
+            for pre in plan.prereqs or ():
+                if id(pre) not in nodes:
+                    nodes[id(pre)] = pre
+                    stack.append(pre)
+        return list(nodes.values())
+
+    def users(self):
+        """ Return a dictionary that tells, for the id of every plan in this
+        one, how many different plans need it as a prerequisite.
+        """
+        users = {id(self): 0}
+        stack = [self]
+        while stack:
+            plan = stack.pop()
+            for pre in distinct(plan.prereqs or ()):
+                if id(pre) not in users:
+                    users[id(pre)] = 0
+                    stack.append(pre)
+                users[id(pre)] += 1
+        return users
+
+
+def distinct(plans):
+    """ Return the list of plans, with every plan only once. """
+    seen = set()
+    res = []
+    for plan in plans:
+        if id(plan) not in seen:
+            seen.add(id(plan))
+            res.append(plan)
+    return res
+
+
+def evaluate(root, children, finish, memo):
+    """ Return the result for root, computed without recursion, so that
+    long chains of prerequisites don't run into Python's recursion limit.
+    root, like every item, is a tuple whose first element is a hashable key
+    for it. children(item) returns the list of items that item depends on,
+    and finish(item, kids, results) returns the result for item, given the
+    items kids returned by children, and their results. Results are stored
+    in the dictionary memo by key, and items already in memo are not
+    computed again.
+    """
+    stack = [(root, None)]
+    active = set()
+    while stack:
+        item, kids = stack.pop()
+        key = item[0]
+        if key in memo:
+            continue
+        if kids is None:
+            if key in active:
+                msg = "{} is its own prerequisite.".format(item[1])
+                raise ValueError(msg)
+            active.add(key)
+            kids = children(item)
+            stack.append((item, kids))
+            stack.extend(
+                (kid, None) for kid in reversed(kids) if kid[0] not in memo
+            )
+            continue
+        memo[key] = finish(item, kids, [memo[kid[0]] for kid in kids])
+        active.discard(key)
+    return memo[root[0]]
+
+
+class Planner:
+    """ Builds Plans for the backend p, which may be None. Everything that is
+    resolved about a dataname and a dictionary of pars is remembered, so
+    that getting the defaults, the idpars and the prerequisites of the same
+    data again, as happens at every level of a chain of prerequisites, costs
+    nothing. Items for evaluate are triples (memo_key, dataname, pars).
+    """
+
+    def __init__(self, p):
+        self.p = p
+        self.modulenames = {}
+        self.added_defaults = {}
+        self.idpars = {}
+        self.plans = {}
+
+    @staticmethod
+    def memo_key(dataname, pars):
+        return dataname, PactBackend.canonical_string(pars)
+
+    def item(self, dataname, pars):
+        return self.memo_key(dataname, pars), dataname, pars
+
+    def setupmod(self, dataname, pars, memo_key):
+        # get_setupmod_name searches the import path, so only do it once.
+        if memo_key not in self.modulenames:
+            modulename = get_setupmod_name(dataname, pars)
+            self.modulenames[memo_key] = modulename
+        return importlib.import_module(self.modulenames[memo_key])
+
+    def default_pars(self, dataname, pars):
+        """ Return a copy of pars, updated with the default values of
+        dataname and its prerequisites. Values that the prerequisites get
+        come before the defaults of dataname's own module.
+        """
+
+        def children(item):
+            memo_key, dataname, pars = item
+            setupmod = self.setupmod(dataname, pars, memo_key)
+            pars_copy = pars.copy()
+            apply_parinfo_defaults(pars_copy, setupmod.parinfo)
+            prereq_pairs = setupmod.prereq_pairs(dataname, pars_copy)
+            return [self.item(*pair) for pair in prereq_pairs]
+
+        def finish(item, kids, results):
+            memo_key, dataname, pars = item
+            prereq_pars_all = dict()
+            for (_, _, prereq_pars), added in zip(kids, results):
+                prereq_pars_all.update(prereq_pars)
+                prereq_pars_all.update(added)
+            added = {k: v for k, v in prereq_pars_all.items() if k not in pars}
+            setupmod = self.setupmod(dataname, pars, memo_key)
+            for k, v in setupmod.parinfo.items():
+                if k not in pars and k not in added:
+                    added[k] = v["default"]
+            return added
+
+        item = self.item(dataname, pars)
+        added = evaluate(item, children, finish, self.added_defaults)
+        pars = pars.copy()
+        pars.update(added)
+        return pars
+
+    def get_idpars(self, dataname, pars):
+        """ Return the idpars for dataname and pars, which should include
+        the default values. These are the idpars of the prerequisites, and
+        the parameters that dataname's module says identify the data.
+        """
+
+        def children(item):
+            memo_key, dataname, pars = item
+            setupmod = self.setupmod(dataname, pars, memo_key)
+            prereq_pairs = setupmod.prereq_pairs(dataname, pars)
+            return [self.item(*pair) for pair in prereq_pairs]
+
+        def finish(item, kids, results):
+            memo_key, dataname, pars = item
+            setupmod = self.setupmod(dataname, pars, memo_key)
+            idpars = dict()
+            for prereq_idpars in results:
+                idpars.update(prereq_idpars)
+            for k, v in setupmod.parinfo.items():
+                if v["idfunc"](dataname, pars):
+                    idpars[k] = pars[k]
+            if hasattr(setupmod, "version"):
+                modulename = self.modulenames[memo_key]
+                idpars[modulename + "_version"] = setupmod.version
+            if hasattr(setupmod, "idpars_finalize"):
+                idpars = setupmod.idpars_finalize(pars, idpars)
+            return idpars
+
+        item = self.item(dataname, pars)
+        return evaluate(item, children, finish, self.idpars).copy()
+
+    def plan(self, dataname, pars):
+        """ Return the Plan for dataname and pars, which don't need to
+        include the default values.
+        """
+
+        def plan_item(dataname, pars):
+            pars = pars.copy()
+            apply_parinfo_defaults(pars, parinfo)
+            return self.item(dataname, self.default_pars(dataname, pars))
+
+        def children(item):
+            memo_key, dataname, pars = item
+            setupmod = self.setupmod(dataname, pars, memo_key)
+            prereq_pairs = setupmod.prereq_pairs(dataname, pars)
+            return [plan_item(*pair) for pair in prereq_pairs]
+
+        def finish(item, kids, results):
+            memo_key, dataname, pars = item
+            idpars = self.get_idpars(dataname, pars)
+            key = None if self.p is None else self.p.generate_key(idpars)
+            modulename = self.modulenames[memo_key]
+            return Plan(dataname, pars, idpars, modulename, key, results)
+
+        item = plan_item(dataname, pars)
+        return evaluate(item, children, finish, self.plans)
+
+
+def make_plan(p, dataname, pars, **kwargs):
+    """ Return the Plan for dataname and pars updated with kwargs, with the
+    keys for the backend p, which may be None. The time it took is stored
+    as plan.planning_time.
+    """
+    start = time.time()
+    planner = Planner(p)
+    plan = planner.plan(dataname, copy_update(pars, **kwargs))
+    apply_storage_policies(plan)
+    plan.planning_time = time.time() - start
+    msg = "Planned {} nodes for {} in {:.3g} s."
+    logging.debug(msg.format(len(planner.plans), dataname, plan.planning_time))
+    return plan
+
+
+def chain_of(plan):
+    """ Return a pair (chain, others) for data that is part of a chain of
+    iterations, where chain identifies the chain, and others are the idpars
+    other than iter_count. Return None for other data.
+    """
+    idpars = plan.idpars
+    if "iter_count" not in idpars or not isinstance(idpars["iter_count"], int):
+        return None
+    others = {k: v for k, v in idpars.items() if k != "iter_count"}
+    if "name" in others:
+        # Can't be given to PactBackend.query as a keyword argument.
+        return None
+    chain = (plan.dataname, PactBackend.canonical_string(others))
+    return chain, others
+
+
+def chain_tops(plan):
+    """ Return a dictionary that tells, for every chain of iterations with a
+    storage policy in plan, the dataname, the other idpars, and the highest
+    iteration in plan, as a triple.
+    """
+    tops = {}
+    for node in plan.nodes():
+        if node.dataname not in storage_policies:
+            continue
+        chain_others = chain_of(node)
+        if chain_others is None:
+            continue
+        chain, others = chain_others
+        iter_count = node.idpars["iter_count"]
+        if chain not in tops or tops[chain][2] < iter_count:
+            tops[chain] = (node.dataname, others, iter_count)
+    return tops
+
+
+def apply_storage_policies(plan):
+    """ Set store to False for all the plans in plan that storage_policies
+    says shouldn't be kept.
+    """
+    tops = chain_tops(plan)
+    for node in plan.nodes():
+        chain_others = chain_of(node)
+        if not node.store or chain_others is None:
+            continue
+        chain, others = chain_others
+        if chain in tops:
+            keep = storage_policies[node.dataname]
+            highest = tops[chain][2]
+            node.store = bool(keep(node.idpars["iter_count"], highest))
+    return
+
+
+def chain_rows(p, dataname, chain, others, highest):
+    """ Return the rows (pars, path) that p.query gives for the iterations
+    of chain up to highest. A partial query also matches entries with more
+    idpars than others, which are part of other chains, so those are left
+    out.
+    """
+    rows = p.query(dataname, iter_count=Range(None, highest), **others)
+    res = []
+    for pars, path in rows:
+        rest = {k: v for k, v in pars.items() if k != "iter_count"}
+        if PactBackend.canonical_string(rest) == chain[1]:
+            res.append((pars, path))
+    return res
+
+
+def prune_chains(p, plan):
+    """ Delete from p the stored iterations of the chains in plan that
+    storage_policies says shouldn't be kept, now that the chains have been
+    generated up to their highest iterations in plan.
+    """
+    for chain, (dataname, others, highest) in chain_tops(plan).items():
+        keep = storage_policies[dataname]
+        for pars, path in chain_rows(p, dataname, chain, others, highest):
+            if not keep(pars["iter_count"], highest):
+                p.delete(dataname, pars)
+    return
+
+
+def open_db(db):
+    """ Return the storage backend for db, which is either a backend already,
+    or the path to a folder for a Pact.
+    """
+    if isinstance(db, PactBackend):
+        return db
+    return Pact(db)
+
+
+class WriteBehind:
+    """ A background thread that stores data, with a queue of at most
+    maxsize pieces of data waiting to be stored. See enable_write_behind.
+    """
+
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        # The data waiting to be stored, by pending_key.
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.errors = []
+        self.thread = threading.Thread(
+            target=self.run, name="datadispenser-writer", daemon=True
+        )
+        self.thread.start()
+
+    @staticmethod
+    def pending_key(db, p, dataname, idpars):
+        dbkey = os.path.abspath(db) if isinstance(db, str) else id(db)
+        return dbkey, dataname, p.generate_key(idpars)
+
+    def submit(self, db, p, data, dataname, idpars, cost=None, lease=None):
+        """ Queue data to be stored with p.store, blocking if the queue is
+        full. lease, if given, is the path of a lease to release once the
+        data is stored.
+        """
+        key = self.pending_key(db, p, dataname, idpars)
+        with self.lock:
+            self.pending[key] = data
+        self.queue.put((key, p, data, dataname, idpars, cost, lease))
+        return
+
+    def get(self, db, p, dataname, idpars):
+        """ Return a pair (found, data), where found tells whether data for
+        dataname and idpars is waiting to be stored in db.
+        """
+        key = self.pending_key(db, p, dataname, idpars)
+        with self.lock:
+            if key in self.pending:
+                return True, self.pending[key]
+        return False, None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            key, p, data, dataname, idpars, cost, lease = item
+            try:
+                p.store(data, dataname, idpars, cost=cost)
+            except Exception as e:
+                logging.exception("Failed to store {}".format(dataname))
+                self.errors.append(e)
+            finally:
+                with self.lock:
+                    if self.pending.get(key) is data:
+                        del self.pending[key]
+                if lease is not None:
+                    leases.release(lease)
+                self.queue.task_done()
+
+    def wait(self):
+        """ Wait until everything queued so far has been stored, and raise
+        the first error raised by storing, if any.
+        """
+        self.queue.join()
+        if self.errors:
+            e = self.errors[0]
+            self.errors = []
+            raise e
+        return
+
+    def stop(self):
+        """ Wait for everything to be stored, and stop the thread. """
+        self.queue.put(None)
+        self.thread.join()
+        self.wait()
+        return
+
+
+# The WriteBehind used by generate_data, if write-behind is enabled.
+write_behind = None
+
+
+def enable_write_behind(maxsize=2):
+    """ Make generate_data store data in a background thread, with at most
+    maxsize pieces of data waiting to be stored.
+    """
+    global write_behind
+    if write_behind is None:
+        write_behind = WriteBehind(maxsize)
+    return
+
+
+def disable_write_behind():
+    """ Wait for all data to be stored, and go back to storing data in
+    generate_data itself.
+    """
+    global write_behind
+    if write_behind is not None:
+        wb = write_behind
+        write_behind = None
+        wb.stop()
+    return
+
+
+def wait_for_writes():
+    """ Wait until all data queued for storing has been stored. Raises the
+    first error that storing raised, if any.
+    """
+    if write_behind is not None:
+        write_behind.wait()
+    return
+
+
+# A lease that hasn't been refreshed for this many seconds is considered to
+# be left behind by a process that died, and is removed.
+lease_timeout = 120
+# How often to check whether a lease held by another process is gone.
+lease_poll_interval = 1.0
+
+
+class Leases:
+    """ The leases held by this process. A lease is a lock file, created
+    with O_CREAT | O_EXCL so that only one process can hold it at a time,
+    that marks a piece of data as being generated, see claim. A background
+    thread refreshes the modification times of the held leases, so that a
+    lease only goes stale if its holder dies.
+    """
+
+    def __init__(self):
+        # The inode of every held lease, by path.
+        self.paths = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def acquire(self, path):
+        """ Create the lease at path, and return True, or return False if
+        someone else holds it already.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            f.write("{} {}\n".format(socket.gethostname(), os.getpid()))
+            inode = os.fstat(f.fileno()).st_ino
+        with self.lock:
+            self.paths[path] = inode
+            # Threads don't survive a fork, so check that it's alive.
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.refresh, name="datadispenser-leases"
+                )
+                self.thread.daemon = True
+                self.thread.start()
+        return True
+
+    def release(self, path):
+        with self.lock:
+            inode = self.paths.pop(path, None)
+        try:
+            # If our lease went stale and was taken over, the lease at path
+            # is someone else's.
+            if inode is None or os.stat(path).st_ino == inode:
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+        return
+
+    def release_all(self):
+        with self.lock:
+            paths = list(self.paths)
+        for path in paths:
+            self.release(path)
+        return
+
+    def refresh(self):
+        while True:
+            time.sleep(lease_timeout / 4)
+            with self.lock:
+                paths = list(self.paths)
+            for path in paths:
+                try:
+                    os.utime(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def is_stale(path):
+        try:
+            return time.time() - os.path.getmtime(path) > lease_timeout
+        except FileNotFoundError:
+            return False
+
+    @classmethod
+    def wait(cls, path):
+        """ Wait until the lease at path is released, or goes stale, in which
+        case it is removed.
+        """
+        while os.path.exists(path):
+            if cls.is_stale(path):
+                cls.remove_stale(path)
+                return
+            time.sleep(lease_poll_interval)
+        return
+
+    @classmethod
+    def remove_stale(cls, path):
+        """ Remove the lease at path if it's stale. Checking and removing
+        happen holding a lock, so that when several processes find the same
+        stale lease, the ones that come later don't remove the new lease
+        that the first one may have created meanwhile.
+        """
+        lockpath = os.path.join(os.path.dirname(path), "takeover.lock")
+        with lock_file(lockpath):
+            if cls.is_stale(path):
+                logging.warning("Removing stale lease {}.".format(path))
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        return
+
+
+leases = Leases()
+# Make sure nothing is lost when the process exits. atexit calls these in
+# the reverse order, so the data waiting to be written is stored before any
+# leases that are left are released.
+atexit.register(leases.release_all)
+atexit.register(disable_write_behind)
+
+
+def claim(db, p, plan):
+    """ Make sure that no other process is generating the data for plan at
+    the same time. Returns a triple (lease, found, data). If another process
+    had a lease on the data, this waits until it's done, and if the data was
+    then stored, found is True and data is the data. Otherwise lease is the
+    path of the lease that this process now holds, to be released once the
+    data is stored, or None if p has nowhere to keep leases.
+    """
+    path = p.lease_path(plan.dataname, plan.idpars)
+    if path is None:
+        return None, False, None
+    while True:
+        if leases.acquire(path):
+            # It may have been stored since we found it missing.
+            found, data = fetch_plan(db, p, plan)
+            if found:
+                leases.release(path)
+                return None, True, data
+            return path, False, None
+        msg = "Waiting for another process to generate {} ({})."
+        logging.info(msg.format(plan.dataname, path))
+        leases.wait(path)
+        found, data = fetch_plan(db, p, plan)
+        if found:
+            return None, True, data
+
+
+def get_pending(db, p, dataname, idpars):
+    """ Return a pair (found, data), where found tells whether data for
+    dataname and idpars is waiting to be stored by the write-behind thread.
+    """
+    if write_behind is None:
+        return False, None
+    return write_behind.get(db, p, dataname, idpars)
+
+
 def copy_update(pars, **kwargs):
     pars = pars.copy()
     pars.update(kwargs)
@@ -163,87 +913,300 @@ def update_default_pars(dataname, pars, **kwargs):
     data.
     """
     pars_copy = copy_update(pars, **kwargs)
-    setupmod = get_setupmod(dataname, pars_copy)
-
-    # Get the default for this setupmod, and update those in, since we may need
-    # those to find the prereqs.
-    parinfo = setupmod.parinfo
-    apply_parinfo_defaults(pars_copy, parinfo)
-
-    # Get the pars for the prereqs and update them in.
-    prereq_pairs = setupmod.prereq_pairs(dataname, pars_copy)
-    prereq_pars_all = dict()
-    for prereq_name, prereq_pars in prereq_pairs:
-        update_default_pars(prereq_name, prereq_pars)
-        prereq_pars_all.update(prereq_pars)
-
-    for k, v in prereq_pars_all.items():
+    defaults = Planner(None).default_pars(dataname, pars_copy)
+    for k, v in defaults.items():
         if k not in pars:
             pars[k] = v
-
-    # Update the defaults for this module once more, now into pars, to make
-    # sure that they override those coming from prerequisites.
-    parinfo = setupmod.parinfo
-    apply_parinfo_defaults(pars, parinfo)
     return pars
 
 
 def get_idpars(dataname, pars):
-    setupmod = get_setupmod(dataname, pars)
-    idpars = dict()
+    return Planner(None).get_idpars(dataname, pars)
 
-    # Get the idpars for the prereqs and update them in.
-    prereq_pairs = setupmod.prereq_pairs(dataname, pars)
-    for prereq_name, prereq_pars in prereq_pairs:
-        prereq_idpars = get_idpars(prereq_name, prereq_pars)
-        idpars.update(prereq_idpars)
 
-    # Get the idpars for this setupmod, and update those in.
-    parinfo = setupmod.parinfo
-    for k, v in parinfo.items():
-        if v["idfunc"](dataname, pars):
-            idpars[k] = pars[k]
-    if hasattr(setupmod, "version"):
-        modulename = get_setupmod_name(dataname, pars)
-        idpars[modulename + "_version"] = setupmod.version
-    if hasattr(setupmod, "idpars_finalize"):
-        idpars = setupmod.idpars_finalize(pars, idpars)
-    return idpars
+def generate_data(dataname, pars, db=None):
+    p = None if db is None else open_db(db)
+    plan = make_plan(p, dataname, pars)
+    data = generate_plan(db, p, plan)
+    if p is not None:
+        prune_chains(p, plan)
+    return data
 
 
-def generate_data(dataname, pars, db=None):
-    havedb = True if db is not None else False
-    storedata = pars["store_data"] and havedb
-    if havedb:
-        p = Pact(db)
-    if storedata:
-        idpars = get_idpars(dataname, pars)
-    setupmod = get_setupmod(dataname, pars)
-    prereq_pairs = setupmod.prereq_pairs(dataname, pars)
-    prereqs = []
-    for prereq_name, prereq_pars in prereq_pairs:
-        if havedb:
-            prereq = get_data(db, prereq_name, prereq_pars)
-        else:
-            prereq = generate_data(prereq_name, prereq_pars)
-        prereqs.append(prereq)
+class StorageLookup:
+    """ Tells whether the data for plans is stored in the backend p. Data
+    that is part of a chain of iterations, i.e. that has iter_count among
+    its idpars, is looked up for all the iterations of the chain at once,
+    with one query to the index, instead of asking for the iterations one
+    at a time.
+    """
+
+    def __init__(self, p):
+        self.p = p
+        # For every chain, the highest iter_count it was queried up to, and
+        # the keys of the stored iterations.
+        self.chains = {}
+
+    def stored(self, plan):
+        idpars = plan.idpars
+        chain_others = chain_of(plan)
+        if chain_others is None:
+            return self.p.exists(plan.dataname, idpars)
+        chain, others = chain_others
+        iter_count = idpars["iter_count"]
+        if chain not in self.chains or self.chains[chain][0] < iter_count:
+            rows = chain_rows(self.p, plan.dataname, chain, others, iter_count)
+            keys = {self.p.generate_key(pars) for pars, path in rows}
+            self.chains[chain] = (iter_count, keys)
+            highest = max(
+                (pars["iter_count"] for pars, path in rows), default=None
+            )
+            msg = "Highest stored iteration of {} up to {}: {}"
+            logging.debug(msg.format(plan.dataname, iter_count, highest))
+        return plan.key in self.chains[chain][1]
+
 
+def fetch_plan(db, p, plan, lazy=False, stored=None):
+    """ Return a pair (found, data), where found tells whether the data for
+    plan was stored in p, or waiting to be stored, and could be fetched.
+    stored tells whether p has the data, if that's known already.
+    """
+    found, data = get_pending(db, p, plan.dataname, plan.idpars)
+    if stored is None and not found:
+        stored = p.exists(plan.dataname, plan.idpars)
+    if not found and stored:
+        try:
+            data = p.fetch(plan.dataname, plan.idpars, lazy=lazy)
+            found = True
+        except CorruptEntryError as e:
+            msg = "{} Quarantining it and generating it again."
+            logging.warning(msg.format(e))
+            p.quarantine(plan.dataname, plan.idpars)
+        except FileNotFoundError:
+            # Deleted since, for instance by prune_chains in another process.
+            pass
+    return found, data
+
+
+def generate_plan(db, p, plan, lookup=None):
+    """ Generate the data for plan, fetching the prerequisites from the
+    backend p if they are there, and generating them if not. If p is None,
+    everything is generated, and nothing stored. The prerequisites are
+    worked through in a loop, not recursively, so a chain of iterations is
+    run forward from the highest stored one. The data of a prerequisite is
+    let go of as soon as everything that needs it is done. lookup is the
+    StorageLookup to use for p. Data that is to be stored is claimed before
+    generating it, so that if another process is already generating it,
+    this one waits for it to be stored instead.
+    """
+    if p is not None and lookup is None:
+        lookup = StorageLookup(p)
+    users = plan.users()
+    data = {}
+    checked = set()
+    held = {}
+    stack = [plan]
+
+    def done(node, node_data):
+        data[id(node)] = node_data
+        for pre in distinct(node.prereqs or ()):
+            users[id(pre)] -= 1
+            if not users[id(pre)]:
+                data.pop(id(pre), None)
+        return
+
+    try:
+        while stack:
+            node = stack[-1]
+            if id(node) in data:
+                stack.pop()
+                continue
+            if id(node) not in checked:
+                checked.add(id(node))
+                found = False
+                if node is not plan and p is not None:
+                    stored = lookup.stored(node)
+                    found, node_data = fetch_plan(db, p, node, stored=stored)
+                if not found and node.store and p is not None:
+                    lease, found, node_data = claim(db, p, node)
+                    if lease is not None:
+                        held[id(node)] = lease
+                if found:
+                    stack.pop()
+                    done(node, node_data)
+                    continue
+                if node.prereqs is None:
+                    msg = "{} with idpars {} was expected to be stored in {}."
+                    raise ValueError(
+                        msg.format(node.dataname, node.idpars, db)
+                    )
+                stack.extend(
+                    pre
+                    for pre in reversed(node.prereqs)
+                    if id(pre) not in data
+                )
+                continue
+            stack.pop()
+            prereqs = [data[id(pre)] for pre in node.prereqs]
+            lease = held.get(id(node))
+            node_data = generate_one(db, p, node, prereqs, lease)
+            held.pop(id(node), None)
+            done(node, node_data)
+    finally:
+        for lease in held.values():
+            leases.release(lease)
+    return data[id(plan)]
+
+
+def generate_one(db, p, plan, prereqs, lease=None):
+    """ Generate the data for plan from the data of its prerequisites, and
+    store it, unless p is None. lease, if given, is released once the data
+    is stored.
+    """
+    storedata = plan.store and p is not None
+    dataname, pars, idpars = plan.dataname, plan.pars, plan.idpars
     if storedata:
-        handler, filelogger = set_logging_handlers(p, dataname, pars)
+        handler, filelogger = set_logging_handlers(p, dataname, pars, idpars)
     else:
         filelogger = None
-    data = setupmod.generate(
+    start = time.time()
+    data = plan.setupmod.generate(
         dataname, *prereqs, pars=pars, filelogger=filelogger
     )
+    cost = time.time() - start
     if storedata:
         remove_logging_handlers(logging.getLogger(), handler)
         remove_logging_handlers(filelogger, handler)
 
-    if storedata:
-        p.store(data, dataname, idpars)
+    if storedata and write_behind is not None:
+        write_behind.submit(db, p, data, dataname, idpars, cost, lease)
+        return data
+    elif storedata:
+        p.store(data, dataname, idpars, cost=cost)
+    if lease is not None:
+        leases.release(lease)
     return data
 
 
+def generate_parallel(db, dataname, pars, max_workers=None, plan=None):
+    """ Generate the data for dataname and pars, like generate_data, but
+    first generate all the prerequisites that aren't in db yet in parallel.
+    pars should already include the default values, and plan, if given, is
+    the Plan for them. The prerequisites form a directed acyclic graph,
+    where the same data needed by several others is only one node. Every
+    node is generated by a pool of max_workers processes as soon as the
+    nodes it needs are done, and stored right away, so that the nodes that
+    need it can fetch it from db. For backends that can't be shared between
+    processes, like MemoryPact, a pool of threads is used instead.
+    Prerequisites that aren't stored, because their store_data is False, are
+    generated along with whatever needs them.
+    """
+    p = open_db(db)
+    if plan is None:
+        plan = make_plan(p, dataname, pars)
+    nodes = {}
+    expand_dag(db, p, plan, nodes)
+    if nodes:
+        # Data waiting to be written wouldn't be visible to other processes.
+        wait_for_writes()
+        run_dag(db, p, nodes, max_workers)
+    return generate_plan(db, p, plan)
+
+
+def expand_dag(db, p, plan, nodes, lookup=None):
+    """ Add to the dictionary nodes the prerequisites of plan that need to
+    be generated and stored, and return the set of the ones that plan needs
+    directly. Nodes are keyed by dataname and the key of the idpars, and are
+    dictionaries with the Plan, as "plan", and the set of the keys of the
+    nodes they need, as "deps". lookup is the StorageLookup to use for p.
+    """
+    if lookup is None:
+        lookup = StorageLookup(p)
+    available = {}
+
+    def is_available(pre):
+        if id(pre) not in available:
+            found, data = get_pending(db, p, pre.dataname, pre.idpars)
+            available[id(pre)] = found or lookup.stored(pre)
+        return available[id(pre)]
+
+    def children(item):
+        plan = item[1]
+        return [
+            (id(pre), pre)
+            for pre in plan.prereqs
+            if not pre.store or not is_available(pre)
+        ]
+
+    def finish(item, kids, results):
+        deps = set()
+        for (_, pre), pre_deps in zip(kids, results):
+            if not pre.store:
+                deps |= pre_deps
+                continue
+            key = (pre.dataname, pre.key)
+            if key not in nodes:
+                nodes[key] = {"plan": pre, "deps": pre_deps}
+            deps.add(key)
+        return deps
+
+    return evaluate((id(plan), plan), children, finish, dict())
+
+
+def run_dag(db, p, nodes, max_workers=None):
+    """ Generate and store all the nodes, as given by expand_dag, each one
+    once all its deps are done.
+    """
+    waiting = {key: set(node["deps"]) for key, node in nodes.items()}
+    users = {key: [] for key in nodes}
+    for key, node in nodes.items():
+        for dep in node["deps"]:
+            users[dep].append(key)
+    if p.shared_between_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+    in_worker_process = p.shared_between_processes
+    with executor:
+        running = {}
+
+        def submit(key):
+            del waiting[key]
+            plan = nodes[key]["plan"].pruned()
+            future = executor.submit(
+                generate_node, db, plan, in_worker_process
+            )
+            running[future] = key
+
+        for key in [key for key, deps in waiting.items() if not deps]:
+            submit(key)
+        while running:
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                key = running.pop(future)
+                future.result()
+                for user in users[key]:
+                    waiting[user].discard(key)
+                    if not waiting[user]:
+                        submit(user)
+    logging.info("Generated {} prerequisites in parallel.".format(len(nodes)))
+    return
+
+
+def generate_node(db, plan, in_worker_process=True):
+    """ Generate and store the data for plan, in a worker of run_dag.
+    in_worker_process tells whether the worker is a separate process.
+    """
+    if in_worker_process:
+        # The writer thread of the parent doesn't exist in this process.
+        global write_behind
+        write_behind = None
+    generate_plan(db, open_db(db), plan)
+    return
+
+
 def get_setupmod_name(dataname, pars):
     modulename = (
         None
@@ -268,15 +1231,18 @@ def get_setupmod(dataname, pars):
     return setupmod
 
 
-def set_logging_handlers(p, dataname, pars):
+def set_logging_handlers(p, dataname, pars, idpars):
     rootlogger = logging.getLogger()
     filelogger = logging.getLogger("datadispenser_file")
     filelogger.propagate = False
 
-    idpars = get_idpars(dataname, pars)
-    logfilename = p.generate_path(dataname, idpars, extension=".log")
-    os.makedirs(os.path.dirname(logfilename), exist_ok=True)
-    filehandler = logging.FileHandler(logfilename, mode="w")
+    logfilename = p.log_path(dataname, idpars)
+    if logfilename is not None:
+        os.makedirs(os.path.dirname(logfilename), exist_ok=True)
+        filehandler = logging.FileHandler(logfilename, mode="w")
+    else:
+        # The backend doesn't keep logs.
+        filehandler = logging.NullHandler()
     if "debug" in pars and pars["debug"]:
         filehandler.setLevel(logging.DEBUG)
     else:
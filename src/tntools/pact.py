@@ -5,40 +5,460 @@ a given folder, and given a just a name and dictionary Pact can fetch this data
 from the same folder. Each stored file is also accompanied by a YAML file, that
 gives the dictionary keys in a human-readable format.
 
-Pact should also keep an index file that keeps tracks of all the data that is
-currently stored, but implementing this is only half-done.
+NumPy arrays and abeliantensors tensors, and tuples, lists and dicts of them,
+are by default not pickled, but written in a raw format that is
+memory-mapped when fetched, see pactcodecs.py. Data can also be compressed,
+with a choice of compression for every name of data. The codec and the
+compression used are recorded for every entry, so fetching finds them out
+automatically. benchmark_compression helps with choosing a compression.
+
+Pact also keeps an index of all the data that is currently stored, in an
+SQLite database called pactindex.sqlite in the same folder. The index is keyed
+by the name and the hash of the dictionary, so inserts and lookups take
+logarithmic time in the number of entries. If the index is missing or out of
+date, it is rebuilt from the YAML files.
+
+Several processes can safely use the same folder at the same time: Files are
+written to a temporary file first and then renamed into place, so a file is
+never seen half-written, and an entry is only added to the index after its
+files are complete. Writes to the index are serialized by SQLite's locking,
+and rebuilding the index by a lock file.
+
+By default all files are in the folder itself. For folders with very many
+entries, Pact can instead use a sharded layout, where the files are in
+subfolders named by the first characters of the hash, like
+ab/cd/name_abcd....p. The layout is recorded in the index, and
+migrate_layout moves an existing folder from one layout to the other, while
+other processes keep using it. Entries are always found through the index, so
+entries in either layout can be fetched.
+
+The index also records the size of every entry, when it was last accessed, and
+how long it took to generate, if known. gc uses these to delete entries when
+the folder grows beyond a given size, starting with the ones that are large,
+not used lately, and cheap to generate again.
+
+The hash of a dictionary is computed from a canonical form of it, where for
+instance 1 and 1.0, NumPy and Python scalars, tuples and lists, and different
+ways of writing the same NumPy dtype are all considered equal, see
+canonical_value. Older versions of Pact hashed the str of every value
+instead. Entries stored with such legacy hashes are still found, and
+key_merge_report tells how many of them would be merged by the new hashing.
+
+With dedup=True, identical data is only stored once: the data is written to
+the subfolder blobs, in a file named by the SHA-256 hash of its contents, and
+the data file of the entry is just a small pointer to it. If a blob with the
+same contents already exists, it is used instead. The index counts the
+references to every blob, and a blob is deleted when no entry uses it
+anymore.
+
+With pack_threshold set, entries whose data is small are not written to
+files of their own, but appended to large segment files in the subfolder
+segments, and the index records where in which segment each one is. This
+saves a lot of files and system calls for entries like spectra or free
+energies. Deleting or replacing such entries leaves garbage in the segments,
+which compact_segments cleans up. Segments are only ever appended to, except
+by compact_segments, which writes new ones and then removes the old.
+
+The index also records the length and the SHA-256 checksum of the data of
+every entry. They are also written as a comment on the first line of the YAML
+file, or in the record of a packed entry, so that they survive rebuilding the
+index. The length is checked on every fetch, which catches files cut short by
+interrupted writes, and with verify=True the checksum is checked too. A
+corrupt entry raises a CorruptEntryError. verify checks the whole folder in
+parallel, and moves corrupt entries to the subfolder quarantine, so that they
+can be generated again.
+
+A Pact opened with readonly=True never writes anything to the folder, and
+takes no locks, so any number of processes can read a finished folder at
+once. The index is read into memory when first used, and the last access
+times of entries are not updated. If the folder has a snapshot manifest,
+written by write_manifest, every entry is checked against it when fetched, so
+that data changed or replaced after the snapshot is never returned.
+
+Fetched data can be kept in memory in a FetchCache, so that fetching the same
+data again within a process doesn't touch the disk.
 
 The datadispenser.py module makes extensive use of Pact as a storage backend.
 """
 
+import abc
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import hashlib
+import io
+import json
+import math
+import numbers
 import pickle
 import os
 import logging
+import random
+import shutil
+import sqlite3
+import struct
+import sys
+import argparse
+import tempfile
+import threading
+import time
+import urllib.parse
+import numpy as np
 import yaml
+from abeliantensors import AbelianTensor
+from . import pactcodecs
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where lock_file does nothing.
+    fcntl = None
 
-# TODO Is the whole class structure necessary?
-class Pact:
-    def __init__(self, folder):
-        self.folder = folder
-        self.indexpath = folder + "pactindex.p"
 
-    def generate_filename(self, name, d, extension=".p", **kwargs):
+# The permissions that files get when created with open, which mkstemp
+# restricts to the owner. Reading the umask means setting it, so this is
+# done once, when the module is imported, and not while other threads may
+# be creating files.
+umask = os.umask(0)
+os.umask(umask)
+file_mode = 0o666 & ~umask
+
+
+def mkstemp(dirname, prefix="", suffix=".tmp"):
+    """ Like tempfile.mkstemp, but the file gets the same permissions as a
+    file created with open would, so that other users can read it once it's
+    renamed to its final path.
+    """
+    fd, tmppath = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=dirname)
+    if hasattr(os, "fchmod"):
+        os.fchmod(fd, file_mode)
+    return fd, tmppath
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode="wb"):
+    """ A context manager that opens a temporary file in the same folder as
+    path for writing, and when exiting without an error, renames the
+    temporary file to path. Other processes thus either see the old file, or
+    the complete new one, never a partially written one.
+    """
+    dirname, basename = os.path.split(path)
+    fd, tmppath = mkstemp(dirname, prefix=basename + ".")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmppath, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmppath)
+        raise
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    """ A context manager that holds an exclusive lock on the file at path,
+    creating it if necessary, blocking until the lock is available.
+    """
+    with open(path, "a") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class CorruptEntryError(ValueError):
+    """ Raised when the data of an entry doesn't have the length or the
+    checksum recorded for it.
+    """
+
+
+class HashingWriter:
+    """ A wrapper for a binary file, that computes the SHA-256 hash of what
+    is written to it. If the file is seeked, the hash is no longer valid, and
+    digest returns None.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.hash = hashlib.sha256()
+        self.seeked = False
+
+    def write(self, b):
+        self.hash.update(b)
+        return self.f.write(b)
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, *args):
+        self.seeked = True
+        return self.f.seek(*args)
+
+    def digest(self):
+        return None if self.seeked else self.hash.hexdigest()
+
+
+blob_pointer_magic = b"PACTPTR\x01"
+# The first line of the YAML file of an entry, with the checksum and the
+# length of the data.
+pars_file_comment = "# sha256 {} length {}\n"
+# Every record in a segment starts with this, followed by the lengths of the
+# pickled header and the data, and the header and the data themselves.
+segment_record_magic = b"PACTREC\x01"
+segment_record_struct = struct.Struct("<IQ")
+
+
+def file_digest(path, chunksize=2 ** 24):
+    """ Return the SHA-256 hash of the contents of the file at path. """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_blob_pointer(path):
+    """ If the file at path is a pointer to a blob, return the hash of the
+    blob, otherwise return None.
+    """
+    with open(path, "rb") as f:
+        start = f.read(len(blob_pointer_magic) + 65)
+    if start.startswith(blob_pointer_magic):
+        return start[len(blob_pointer_magic) :].decode("ascii")
+    return None
+
+
+def canonical_value(v):
+    """ Return a canonical form of the parameter value v, made of Python
+    bools, ints, floats, strings, None, lists and dicts, so that values that
+    should be considered the same have the same canonical form. In
+    particular
+    - NumPy scalars are converted to Python scalars,
+    - floats with integer values are converted to ints, so 1.0 == 1,
+    - complex numbers with no imaginary part are treated as real numbers,
+    - tuples and NumPy arrays are converted to lists,
+    - NumPy dtypes, and anything else np.dtype understands as a dtype, such
+      as np.float_ and np.float64, are converted to a string naming the
+      dtype,
+    - other classes are converted to a string naming the class.
+    Anything else is converted to its str.
+    """
+    if v is None or isinstance(v, (bool, np.bool_)):
+        return v if v is None else bool(v)
+    elif isinstance(v, str):
+        return v
+    elif isinstance(v, numbers.Integral):
+        return int(v)
+    elif isinstance(v, numbers.Real):
+        v = float(v)
+        if math.isfinite(v) and v.is_integer():
+            return int(v)
+        elif math.isfinite(v):
+            return v
+        else:
+            return str(v)
+    elif isinstance(v, numbers.Complex):
+        if v.imag == 0:
+            return canonical_value(v.real)
+        return {"complex": [canonical_value(v.real), canonical_value(v.imag)]}
+    elif isinstance(v, (tuple, list, np.ndarray)):
+        return [canonical_value(x) for x in v]
+    elif isinstance(v, dict):
+        return {str(k): canonical_value(x) for k, x in v.items()}
+    elif isinstance(v, np.dtype):
+        return "dtype:" + v.name
+    elif isinstance(v, type):
+        try:
+            dtype = np.dtype(v)
+        except TypeError:
+            dtype = None
+        # np.dtype turns any class it doesn't know into the object dtype.
+        if dtype is not None and (
+            dtype != np.dtype(object) or issubclass(v, np.generic)
+        ):
+            return "dtype:" + dtype.name
+        return "class:{}.{}".format(v.__module__, v.__qualname__)
+    return str(v)
+
+
+class Range:
+    """ A filter for Pact.query, that matches numerical parameters with
+    values lo <= v <= hi. Either bound can be None, for no bound.
+    """
+
+    def __init__(self, lo=None, hi=None):
+        self.lo = lo
+        self.hi = hi
+
+    def __repr__(self):
+        return "Range({!r}, {!r})".format(self.lo, self.hi)
+
+
+def data_nbytes(data):
+    """ Return an estimate of the memory used by data, counting the arrays
+    and tensors in it in full.
+    """
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    elif isinstance(data, AbelianTensor):
+        return sum(data_nbytes(v) for v in data.sects.values())
+    elif type(data) in (tuple, list):
+        return sys.getsizeof(data) + sum(data_nbytes(x) for x in data)
+    elif type(data) is dict:
+        return sys.getsizeof(data) + sum(data_nbytes(x) for x in data.values())
+    else:
+        return sys.getsizeof(data)
+
+
+def make_readonly(data):
+    """ Mark all the arrays and tensor sectors in data as read-only. """
+    if isinstance(data, np.ndarray):
+        data.flags.writeable = False
+    elif isinstance(data, AbelianTensor):
+        for v in data.sects.values():
+            make_readonly(v)
+    elif type(data) in (tuple, list):
+        for x in data:
+            make_readonly(x)
+    elif type(data) is dict:
+        for x in data.values():
+            make_readonly(x)
+    return
+
+
+class FetchCache:
+    """ An in-memory cache for data fetched by Pact, holding at most
+    max_bytes bytes of data, as estimated by data_nbytes, and evicting the
+    least recently used data when full. hits, misses and evictions count how
+    the cache has done.
+
+    So that callers can't corrupt the cached data, by default every call to
+    get returns a deep copy. If copy is False, the cached data itself is
+    returned, but all the arrays in it are made read-only, so modifying them
+    raises an error. Tuples, lists, dicts and tensor objects themselves
+    aren't protected, so with copy=False callers should not modify those.
+    """
+
+    def __init__(self, max_bytes, copy=True):
+        self.max_bytes = max_bytes
+        self.copy = copy
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (data, nbytes), ordered from least to most recently used.
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """ Return the data cached under key, or None if there is none. """
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            data = self.entries[key][0]
+        if self.copy:
+            data = copy.deepcopy(data)
+        return data
+
+    def put(self, key, data):
+        """ Cache data under key, unless it alone is larger than the cache.
+        Note that the data is not copied.
+        """
+        nbytes = data_nbytes(data)
+        if nbytes > self.max_bytes:
+            return
+        if not self.copy:
+            make_readonly(data)
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (data, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                evicted_key, (evicted, evicted_nbytes) = self.entries.popitem(
+                    last=False
+                )
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+        return
+
+    def remove(self, key):
+        if key in self.entries:
+            self.nbytes -= self.entries.pop(key)[1]
+        return
+
+    def invalidate(self, key):
+        with self.lock:
+            self.remove(key)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+        return
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "nbytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class PactBackend(abc.ABC):
+    """ The interface of a storage backend for Pact-like stores, that store
+    data identified by a name and a dictionary. Subclasses implement exists,
+    fetch, store, delete and query, which are abstract, so that a backend
+    missing one of them can't be instantiated. Pact itself is the backend
+    that stores every entry as files in a folder, MemoryPact and SQLitePact
+    in pactbackends.py keep them in memory and in a single SQLite file.
+
+    The methods for turning dictionaries into keys are shared by all
+    backends, so that the same data has the same key everywhere.
+    """
+
+    def generate_key(self, d, legacy=False, **kwargs):
+        """ Return the hash that identifies the dictionary d. If legacy is
+        True, the hash used by older versions of Pact is returned instead.
+        """
         d = self.update_dict(d, **kwargs)
-        suffix = type(self).dict_to_string(d)
-        suffix = type(self).hash_str(suffix)
-        filename = name + "_" + suffix + extension
-        return filename
+        if legacy:
+            key = type(self).dict_to_string(d)
+        else:
+            key = type(self).canonical_string(d)
+        key = type(self).hash_str(key)
+        return key
 
-    def generate_path(self, *args, filename=None, **kwargs):
-        if filename is None:
-            filename = self.generate_filename(*args, **kwargs)
-        path = self.folder + filename
-        return path
+    @staticmethod
+    def canonical_string(d):
+        """ Return a string that identifies the dictionary d, such that
+        dictionaries with the same canonical values get the same string.
+        """
+        return json.dumps(
+            canonical_value(d), sort_keys=True, separators=(",", ":")
+        )
 
     @staticmethod
     def dict_to_string(d):
+        # The legacy way of turning d into a string, see generate_key.
         d = sorted(d.items())
         first_item = d[0]
         postfix = "{}-{}".format(first_item[0], first_item[1])
@@ -52,27 +472,18 @@ class Pact:
         string = hashlib.md5(bstring).hexdigest()
         return string
 
-    # # #
-
-    @classmethod
-    def dict_to_hashable(cls, d):
-        # TODO Could we use a yaml.dump string for this purpose?
-        # For the purpose of using a dict d as a key for some other
-        # dict, we convert d into something hashable.
-        d = d.copy()
-        for k, v in d.items():
-            try:
-                hash(v)
-            except TypeError:
-                if type(v) is list:
-                    v = tuple(v)
-                elif type(v) is dict:
-                    v = cls.dict_to_hashable(v)
-                else:
-                    raise
-                d[k] = v
-        fs = frozenset(d.items())
-        return fs
+    @staticmethod
+    def par_to_columns(v):
+        """ Return the pair (num, text) that is stored in the index for the
+        parameter value v. Real numbers are stored as floats, so that they
+        can be compared and range filtered, and everything else as the JSON
+        of its canonical_value.
+        """
+        v = canonical_value(v)
+        if isinstance(v, (int, float)) and not isinstance(v, bool):
+            return float(v), None
+        else:
+            return None, json.dumps(v, sort_keys=True, separators=(",", ":"))
 
     def update_dict(self, d, **kwargs):
         res = d.copy()
@@ -80,57 +491,2052 @@ class Pact:
         res.update(kwargs)
         return res
 
-    def store(self, data, name, d, extension=".p", **kwargs):
+    # Whether different processes that open the same backend see the same
+    # data, so that data stored by one can be fetched by the others.
+    shared_between_processes = True
+
+    def __getstate__(self):
+        # Connections and caches can't be pickled, or sent to other
+        # processes. The copy opens its own connections when needed.
+        state = self.__dict__.copy()
+        state.pop("_local", None)
+        state.pop("cache", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    @abc.abstractmethod
+    def exists(self, name, d, **kwargs):
+        """ Return whether data with this name and d has been stored. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def fetch(self, name, d, lazy=False, **kwargs):
+        """ Return the data stored with name and d. Raises
+        FileNotFoundError if there's no such data.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def store(self, data, name, d, cost=None, **kwargs):
+        """ Store data with name and d. cost is the time in seconds it took
+        to generate the data, if known.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete(self, name, d, **kwargs):
+        """ Delete the entry for name and d. Returns whether there was such
+        an entry.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def query(self, name, **partial_pars):
+        """ Return a list of pairs (pars, path), one for each stored entry
+        called name, whose pars match partial_pars. Each value in
+        partial_pars is either a value that the parameter should be equal to,
+        or a Range for numerical parameters. Parameters not in partial_pars
+        can have any value. path is the path of the data file, or None for
+        entries that don't have a file of their own, such as the ones of
+        backends that don't store entries in files, or packed entries.
+        """
+        raise NotImplementedError
+
+    def store_many(self, items, **kwargs):
+        """ Store many entries at once. items is an iterable of triples
+        (data, name, d).
+        """
+        for data, name, d in items:
+            self.store(data, name, d, **kwargs)
+        return
+
+    def fetch_many(self, pairs, lazy=False, **kwargs):
+        """ Fetch many entries at once. pairs is an iterable of pairs
+        (name, d). Returns a generator of triples (name, d, data). Raises
+        FileNotFoundError right away if any of the entries is missing.
+        """
+        pairs = list(pairs)
+        for name, d in pairs:
+            if not self.exists(name, d):
+                raise FileNotFoundError("No entry for {} {}".format(name, d))
+        return ((name, d, self.fetch(name, d, lazy=lazy)) for name, d in pairs)
+
+    def quarantine(self, name, d, **kwargs):
+        """ Remove the entry for name and d, because its data is corrupt,
+        keeping the data aside for inspection if the backend can. Returns
+        whether there was such an entry. By default the entry is just
+        deleted.
+        """
+        return self.delete(name, d, **kwargs)
+
+    def log_path(self, name, d):
+        """ Return the path of the log file that goes with the entry for name
+        and d, or None if the backend doesn't keep log files.
+        """
+        return None
+
+    def lease_path(self, name, d):
+        """ Return the path of the lock file that marks the entry for name
+        and d as being generated by some process, so that other processes
+        can wait for it instead of generating it too, or None if the backend
+        has nowhere to keep such files.
+        """
+        return None
+
+    def close(self):
+        return
+
+    @staticmethod
+    def pars_filter(name, partial_pars):
+        """ Return an SQL condition and its arguments, that select the keys
+        of the entries called name whose pars match partial_pars, from a
+        table pars that has a row (name, key, par, num, text) for every
+        parameter of every entry, as given by par_to_columns. See query.
+        """
+        args = []
+        subqueries = []
+        for k, v in partial_pars.items():
+            subquery = "SELECT key FROM pars WHERE name = ? AND par = ?"
+            args += [name, k]
+            if isinstance(v, Range):
+                if v.lo is not None:
+                    subquery += " AND num >= ?"
+                    args.append(float(v.lo))
+                if v.hi is not None:
+                    subquery += " AND num <= ?"
+                    args.append(float(v.hi))
+                if v.lo is None and v.hi is None:
+                    subquery += " AND num IS NOT NULL"
+            else:
+                num, text = PactBackend.par_to_columns(v)
+                if num is not None:
+                    subquery += " AND num = ?"
+                    args.append(num)
+                else:
+                    subquery += " AND text = ?"
+                    args.append(text)
+            subqueries.append(subquery)
+        if subqueries:
+            cond = " AND key IN ({})".format(" INTERSECT ".join(subqueries))
+        else:
+            cond = ""
+        return cond, args
+
+    @staticmethod
+    def pars_match(d, partial_pars):
+        """ Return whether the dictionary d matches partial_pars, in the
+        sense of query.
+        """
+        for k, v in partial_pars.items():
+            if k not in d:
+                return False
+            num, text = PactBackend.par_to_columns(d[k])
+            if isinstance(v, Range):
+                if num is None:
+                    return False
+                if v.lo is not None and num < v.lo:
+                    return False
+                if v.hi is not None and num > v.hi:
+                    return False
+            elif (num, text) != PactBackend.par_to_columns(v):
+                return False
+        return True
+
+
+class Pact(PactBackend):
+    # Bump this whenever the schema of the index changes. An index with a
+    # different version is rebuilt from the YAML files when opened.
+    index_version = 10
+    # The columns of the entries table of the index, in order.
+    entry_columns = (
+        "name",
+        "key",
+        "filename",
+        "pars",
+        "codec",
+        "compression",
+        "size",
+        "accessed",
+        "cost",
+        "blob",
+        "segment",
+        "offset",
+        "length",
+        "checksum",
+    )
+    # Extensions of the other files that go with a data file.
+    sidecar_extensions = (".yaml", ".log")
+    # Subfolders of the folder that don't hold entries of the sharded or flat
+    # layout, and aren't scanned when reconstructing the index.
+    special_folders = ("quarantine", "blobs", "segments", "leases")
+    # The last access time of an entry in the index is only updated if it's
+    # older than this many seconds, to avoid writing to the index on every
+    # fetch.
+    access_resolution = 60
+    # A new segment is started when the last one is larger than this.
+    segment_size = 2 ** 28
+    # The FetchCache used by all instances of Pact that aren't given one
+    # explicitly. None means no caching.
+    cache = None
+
+    def __init__(
+        self,
+        folder,
+        native_arrays=True,
+        compression=None,
+        cache=None,
+        dedup=False,
+        pack_threshold=None,
+        readonly=False,
+        verify=False,
+    ):
+        """ If native_arrays is True, data that contains arrays or tensors is
+        written with the npy codec of pactcodecs, instead of being pickled.
+        compression is the name of one of the compressions in pactcodecs, to
+        compress all stored data with, or a dictionary with names of data as
+        keys and names of compressions as values, to compress only some data.
+        By default nothing is compressed. cache is a FetchCache to use
+        instead of the class attribute Pact.cache. If dedup is True, data
+        is stored in content-addressed blobs, so that identical data is only
+        stored once. If pack_threshold is not None, data that takes at most
+        this many bytes in memory is appended to segment files instead of
+        being written to a file of its own. If readonly is True, nothing is
+        ever written to the folder, and trying to store or delete raises a
+        PermissionError. If verify is True, the checksum of every entry is
+        checked when it is fetched, and not just its length.
+        """
+        if cache is not None:
+            self.cache = cache
+        self.folder = folder
+        self.native_arrays = native_arrays
+        self.compression = compression
+        self.dedup = dedup
+        self.pack_threshold = pack_threshold
+        self.segmentfolder = folder + "segments/"
+        self.packlockpath = self.segmentfolder + "pack.lock"
+        self.indexpath = folder + "pactindex.sqlite"
+        self.lockpath = folder + "pactindex.lock"
+        self.manifestpath = folder + "pactmanifest.json"
+        self.readonly = readonly
+        self.verify = verify
+        self._manifest = None
+        # Every thread has its own connection to the index, since SQLite
+        # connections can't be shared between threads.
+        self._local = threading.local()
+        self._layout = None
+
+    def generate_filename(self, name, d, extension=".p", **kwargs):
+        """ Return the path of the file for name and d, relative to the
+        folder. Despite the name, this includes the subfolders of the sharded
+        layout, if that's in use.
+        """
+        key = self.generate_key(d, **kwargs)
+        return type(self).key_to_filename(name, key, extension, self.layout)
+
+    @staticmethod
+    def key_to_filename(name, key, extension, layout):
+        filename = name + "_" + key + extension
+        if layout == "sharded":
+            filename = os.path.join(key[:2], key[2:4], filename)
+        return filename
+
+    @property
+    def layout(self):
+        """ The layout used for new files, "flat" or "sharded", as recorded
+        in the index.
+        """
+        if self._layout is None:
+            row = self.index.execute(
+                "SELECT value FROM meta WHERE key = 'layout'"
+            ).fetchone()
+            self._layout = "flat" if row is None else row["value"]
+        return self._layout
+
+    def generate_path(self, *args, filename=None, **kwargs):
+        if filename is None:
+            filename = self.generate_filename(*args, **kwargs)
+        path = self.folder + filename
+        return path
+
+    # # #
+
+    def get_codec(self, data):
+        if self.native_arrays:
+            return pactcodecs.choose_codec(data)
+        else:
+            return "pickle"
+
+    def get_compression(self, name):
+        if isinstance(self.compression, dict):
+            return self.compression.get(name, None)
+        else:
+            return self.compression
+
+    def store(self, data, name, d, extension=".p", cost=None, **kwargs):
+        """ Store data with name and d. cost is the time in seconds it took
+        to generate the data, if known, and is used by gc.
+        """
+        self.check_writable()
         d = self.update_dict(d, **kwargs)
+        row = self.write_entry(data, name, d, extension=extension, cost=cost)
+        self.commit_rows([row])
+        if self.cache is not None:
+            self.cache.invalidate(self.cache_key(name, d))
+        return
+
+    def store_many(self, items, extension=".p", max_workers=8):
+        """ Store many entries at once. items is an iterable of triples
+        (data, name, d). The files are written concurrently by a pool of
+        max_workers threads, and the index is updated once in the end.
+        """
+        self.check_writable()
+        # Make sure the layout is known before starting the threads, so that
+        # they don't each open a connection to the index to find it out.
+        self.layout
+
+        def write(item):
+            data, name, d = item
+            return self.write_entry(data, name, d, extension=extension)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            rows = list(executor.map(write, items))
+        self.commit_rows(rows)
+        if self.cache is not None:
+            for row in rows:
+                self.cache.invalidate(self.cache_key(row["name"], row["pars"]))
+        return
+
+    def commit_rows(self, rows):
+        """ Append the packed ones of rows, as returned by write_entry, to a
+        segment, and insert all of them into the index. The lock on the
+        segments is held until the index is updated, so that
+        compact_segments doesn't remove a segment that the index is about
+        to point to.
+        """
+        packed = [row for row in rows if "record" in row]
+        with contextlib.ExitStack() as stack:
+            if packed:
+                os.makedirs(self.segmentfolder, exist_ok=True)
+                stack.enter_context(lock_file(self.packlockpath))
+                self.append_records(packed)
+            with self.index as conn:
+                self.insert_index_rows(conn, rows)
+        return
+
+    def write_entry(self, data, name, d, extension=".p", cost=None):
+        """ Write the files for an entry, and return its row for the index,
+        without adding it to the index. Data to be packed isn't written
+        anywhere yet, but serialized into row["record"], for commit_rows to
+        append to a segment.
+        """
         filename = self.generate_filename(name, d, extension=extension)
         path = self.generate_path(filename=filename)
+        codec = self.get_codec(data)
+        compression = self.get_compression(name)
+        if (
+            self.pack_threshold is not None
+            and data_nbytes(data) <= self.pack_threshold
+        ):
+            return self.pack_entry(data, name, d, filename, codec, cost)
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "wb") as f:
-            pickle.dump(data, f)
-        self.write_to_index(filename, d)
-        self.store_pars_file(name, d)
+        blob = None
+        tmppath = None
+        if self.dedup:
+            tmppath, blob = self.write_blob(data, codec, compression)
+            with atomic_write(path, "wb") as f:
+                f.write(blob_pointer_magic + blob.encode("ascii"))
+            checksum = blob
+            length = os.path.getsize(tmppath)
+        else:
+            with atomic_write(path, "wb") as f:
+                writer = HashingWriter(f)
+                pactcodecs.dump(data, writer, codec, compression)
+                length = f.tell()
+            # Compressed files are seeked when written, and have to be read
+            # again to hash them.
+            checksum = writer.digest() or file_digest(path)
+        self.store_pars_file(name, d, checksum=checksum, length=length)
+        size = self.entry_size(filename)
+        if tmppath is not None:
+            size += os.path.getsize(tmppath)
+        row = self.index_row(
+            name,
+            d,
+            filename,
+            codec=codec,
+            compression=compression,
+            size=size,
+            accessed=time.time(),
+            cost=cost,
+            blob=blob,
+            length=length,
+            checksum=checksum,
+        )
+        # Not a column, but insert_index_rows moves the blob into place.
+        row["tmppath"] = tmppath
         logging.info("Wrote to {}".format(path))
+        return row
+
+    def pack_entry(self, data, name, d, filename, codec, cost=None):
+        """ Serialize data into a segment record, and return the row for the
+        index, with the record in row["record"]. See write_entry.
+        """
+        compression = self.get_compression(name)
+        f = io.BytesIO()
+        pactcodecs.dump(data, f, codec, compression)
+        buf = f.getbuffer()
+        row = self.index_row(
+            name,
+            d,
+            filename,
+            codec=codec,
+            compression=compression,
+            size=len(buf),
+            accessed=time.time(),
+            cost=cost,
+            length=len(buf),
+            checksum=hashlib.sha256(buf).hexdigest(),
+        )
+        header = {
+            "name": name,
+            "key": row["key"],
+            "filename": filename,
+            "pars": d,
+            "codec": codec,
+            "compression": compression,
+            "cost": cost,
+            "checksum": row["checksum"],
+        }
+        # Not a column, but commit_rows appends it to a segment.
+        row["record"] = (pickle.dumps(header), buf)
+        return row
+
+    def segment_path(self, segment):
+        return self.segmentfolder + segment
+
+    def list_segments(self):
+        """ Return the names of all the segments, oldest first. """
+        try:
+            names = os.listdir(self.segmentfolder)
+        except FileNotFoundError:
+            return []
+        return sorted(n for n in names if n.endswith(".pack"))
+
+    def append_records(self, rows):
+        """ Append the records of rows to the last segment, or a new one if
+        it's full, and fill in the segment and offset of each row. Should be
+        called holding the lock at packlockpath. Tombstones, which mark an
+        entry as deleted for reconstruct_index, are rows with a record but
+        no data.
+        """
+        segments = self.list_segments()
+        if segments:
+            segment = segments[-1]
+            if os.path.getsize(self.segment_path(segment)) >= (
+                type(self).segment_size
+            ):
+                segment = "{:08d}.pack".format(int(segment[:-5]) + 1)
+        else:
+            segment = "{:08d}.pack".format(0)
+        path = self.segment_path(segment)
+        with open(path, "ab") as f:
+            offset = f.tell()
+            for row in rows:
+                header, buf = row["record"]
+                f.write(segment_record_magic)
+                f.write(segment_record_struct.pack(len(header), len(buf)))
+                f.write(header)
+                offset += (
+                    len(segment_record_magic)
+                    + segment_record_struct.size
+                    + len(header)
+                )
+                f.write(buf)
+                row["segment"] = segment
+                row["offset"] = offset
+                offset += len(buf)
+            f.flush()
+            os.fsync(f.fileno())
+        logging.info("Appended {} records to {}".format(len(rows), path))
         return
 
-    def store_pars_file(self, name, d, **kwargs):
+    def read_records(self, segment):
+        """ Generate the records of a segment, as triples (header, offset,
+        length), where offset and length locate the data in the segment. A
+        record cut short by a crash ends the iteration.
+        """
+        path = self.segment_path(segment)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            prefix_size = (
+                len(segment_record_magic) + segment_record_struct.size
+            )
+            while True:
+                start = f.tell()
+                prefix = f.read(prefix_size)
+                if not prefix:
+                    return
+                if (
+                    len(prefix) < prefix_size
+                    or prefix[: len(segment_record_magic)]
+                    != segment_record_magic
+                ):
+                    break
+                header_length, length = segment_record_struct.unpack(
+                    prefix[len(segment_record_magic) :]
+                )
+                offset = start + prefix_size + header_length
+                if offset + length > size:
+                    break
+                header = pickle.loads(f.read(header_length))
+                f.seek(length, io.SEEK_CUR)
+                yield header, offset, length
+        msg = "Ignoring a broken record at {} in {}".format(start, path)
+        logging.warning(msg)
+        return
+
+    def write_blob(self, data, codec, compression):
+        """ Write data to a temporary file in the blobs folder, and return
+        its path and the hash of its contents. The file is moved to its
+        place by insert_index_rows, if there isn't already a blob with the
+        same contents.
+        """
+        blobfolder = self.folder + "blobs/"
+        os.makedirs(blobfolder, exist_ok=True)
+        fd, tmppath = mkstemp(blobfolder)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pactcodecs.dump(data, f, codec, compression)
+                f.flush()
+                os.fsync(f.fileno())
+            blob = file_digest(tmppath)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmppath)
+            raise
+        return tmppath, blob
+
+    def blob_path(self, blob):
+        return self.folder + os.path.join("blobs", blob[:2], blob)
+
+    def data_path(self, row):
+        """ Return the path of the file that holds the data of the entry with
+        the given index row.
+        """
+        if row["segment"] is not None:
+            return self.segment_path(row["segment"])
+        elif row["blob"] is not None:
+            return self.blob_path(row["blob"])
+        else:
+            return self.generate_path(filename=row["filename"])
+
+    def store_pars_file(self, name, d, checksum=None, length=None, **kwargs):
         d = self.update_dict(d, **kwargs)
         filename = self.generate_filename(name, d, extension=".yaml")
         path = self.generate_path(filename=filename)
+        type(self).write_pars_file(path, d, checksum, length)
+        return
+
+    @staticmethod
+    def write_pars_file(path, d, checksum=None, length=None):
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        with open(path, "w") as f:
+        with atomic_write(path, "w") as f:
+            if checksum is not None:
+                f.write(pars_file_comment.format(checksum, length))
             yaml.dump(d, f, default_flow_style=False)
         return
 
-    def write_to_index(self, filename, d):
-        try:
-            with open(self.indexpath, "rb") as f:
-                index = pickle.load(f)
-        # TODO Why do we need to catch EOFErrors as well? Why do they
-        # sometimes get raised? Corrupt files?
-        except (EOFError, FileNotFoundError):
-            index = dict()
-        fs = type(self).dict_to_hashable(d)
-        index[fs] = filename
-        with open(self.indexpath, "wb") as f:
-            pickle.dump(index, f)
-        return
-
-    def fetch(self, name, d, extension=".p", **kwargs):
+    @staticmethod
+    def read_pars_file(path):
+        """ Return the dictionary in the YAML file at path, and the checksum
+        and the length of the data from the comment on its first line, or
+        None for them if there's no such comment.
+        """
+        with open(path, "r") as f:
+            text = f.read()
+        d = yaml.load(text, Loader=yaml.UnsafeLoader)
+        checksum, length = None, None
+        first = text.split("\n", 1)[0].split()
+        if first[:2] == ["#", "sha256"] and first[3:4] == ["length"]:
+            checksum, length = first[2], int(first[4])
+        return d, checksum, length
+
+    def fetch(self, name, d, extension=".p", lazy=False, **kwargs):
+        """ Fetch the data stored with name and d. If lazy is True, data
+        stored in the npy format is loaded lazily, so that only the tuple
+        elements and tensor sectors that are accessed are read, see
+        pactcodecs.py.
+
+        If a cache is in use, data is returned from it when possible, and
+        otherwise put in it after reading, unless reading lazily.
+        """
         d = self.update_dict(d, **kwargs)
-        filename = self.generate_filename(name, d, extension=extension)
-        path = self.generate_path(filename=filename)
-        with open(path, "rb") as f:
-            data = pickle.load(f)
+        if self.cache is not None:
+            cache_key = self.cache_key(name, d)
+            data = self.cache.get(cache_key)
+            if data is not None:
+                return data
+        row = self.lookup(name, d)
+        if row is None:
+            path = self.generate_path(name, d, extension=extension)
+            raise FileNotFoundError("No entry in index for {}".format(path))
+        self.touch(row)
+        try:
+            data = self.load_row(row, lazy=lazy)
+        except FileNotFoundError:
+            # The file may have been moved by migrate_layout after we looked
+            # it up, in which case the index knows its new place.
+            # The same goes for compact_segments.
+            newrow = self.lookup(name, d)
+            if newrow is None or (
+                newrow["filename"] == row["filename"]
+                and newrow["segment"] == row["segment"]
+            ):
+                raise
+            data = self.load_row(newrow, lazy=lazy)
+        if self.cache is not None and not lazy:
+            data = self.cache_put(cache_key, data)
+        return data
+
+    def load_row(self, row, lazy=False):
+        """ Load the data of the entry with the given index row. """
+        if self.readonly and self.manifest is not None:
+            self.check_manifest(row)
+        path = self.data_path(row)
+        if row["segment"] is not None:
+            # A bytearray rather than bytes, so that the arrays loaded from
+            # it are writable, as they are when loaded from a file.
+            buf = bytearray(row["length"])
+            with open(path, "rb") as f:
+                f.seek(row["offset"])
+                n = f.readinto(buf)
+            if n != row["length"]:
+                raise CorruptEntryError("{} is cut short.".format(path))
+            if self.verify:
+                self.check_checksum(row, hashlib.sha256(buf).hexdigest())
+            data = pactcodecs.loads(buf, lazy=lazy)
+        else:
+            self.check_length(row, path)
+            if self.verify:
+                self.check_checksum(row, file_digest(path))
+            data = pactcodecs.load(
+                path, row["codec"], row["compression"], lazy=lazy
+            )
         logging.info("Read from {}".format(path))
         return data
 
+    def check_length(self, row, path):
+        length = row["length"]
+        if length is not None and os.path.getsize(path) != length:
+            msg = "{} has {} bytes, expected {}.".format(
+                path, os.path.getsize(path), length
+            )
+            raise CorruptEntryError(msg)
+        return
+
+    def check_checksum(self, row, checksum):
+        if row["checksum"] is not None and checksum != row["checksum"]:
+            path = self.data_path(row)
+            msg = "The checksum of {} doesn't match.".format(path)
+            raise CorruptEntryError(msg)
+        return
+
+    def cache_put(self, cache_key, data):
+        """ Put data in the cache, and return what fetch should return. """
+        self.cache.put(cache_key, data)
+        if self.cache.copy:
+            data = copy.deepcopy(data)
+        return data
+
+    def fetch_many(self, pairs, lazy=False, max_workers=8):
+        """ Fetch many entries at once. pairs is an iterable of pairs
+        (name, d). Returns a generator of triples (name, d, data), in the
+        order in which the reads finish, which need not be the order of
+        pairs. All the entries are looked up in the index right away, and
+        if any of them is missing, FileNotFoundError is raised before
+        anything is read. The files are then read concurrently by a pool of
+        max_workers threads.
+        """
+        cached = []
+        todo = []
+        for name, d in pairs:
+            if self.cache is not None:
+                data = self.cache.get(self.cache_key(name, d))
+                if data is not None:
+                    cached.append((name, d, data))
+                    continue
+            row = self.lookup(name, d)
+            if row is None:
+                path = self.generate_path(name, d)
+                msg = "No entry in index for {}".format(path)
+                raise FileNotFoundError(msg)
+            self.touch(row)
+            todo.append((name, d, row))
+        return self.iter_fetched(cached, todo, lazy, max_workers)
+
+    def iter_fetched(self, cached, todo, lazy, max_workers):
+        yield from cached
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        futures = {}
+        try:
+            for name, d, row in todo:
+                future = executor.submit(self.load_row, row, lazy=lazy)
+                futures[future] = (name, d)
+            for future in concurrent.futures.as_completed(futures):
+                name, d = futures[future]
+                try:
+                    data = future.result()
+                except FileNotFoundError:
+                    # Maybe moved by migrate_layout, fetch knows what to do.
+                    data = self.fetch(name, d, lazy=lazy)
+                else:
+                    if self.cache is not None and not lazy:
+                        data = self.cache_put(self.cache_key(name, d), data)
+                yield name, d, data
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+
     def exists(self, name, d, extension=".p", **kwargs):
+        """ Return whether data with this name and d has been stored. The
+        check is done against the index, so no files are touched. extension
+        is only used when storing, and is accepted here for compatibility.
+        """
         d = self.update_dict(d, **kwargs)
-        filename = self.generate_filename(name, d, extension=extension)
-        path = self.generate_path(filename=filename)
-        exists = os.path.isfile(path)
+        if self.cache is not None and self.cache_key(name, d) in self.cache:
+            return True
+        exists = self.lookup(name, d) is not None
         return exists
 
-    def reconstruct_index(self):
-        # TODO
-        pass
+    def entry_paths(self, filename):
+        """ Return the paths of the data file filename, and the sidecar files
+        that go with it, whether they exist or not.
+        """
+        stem = os.path.splitext(filename)[0]
+        paths = [self.generate_path(filename=filename)]
+        for ext in type(self).sidecar_extensions:
+            paths.append(self.generate_path(filename=stem + ext))
+        return paths
+
+    def entry_size(self, filename):
+        """ Return the total size on disk of the files of an entry. """
+        size = 0
+        for path in self.entry_paths(filename):
+            with contextlib.suppress(FileNotFoundError):
+                size += os.path.getsize(path)
+        return size
+
+    def entry_token(self, row):
+        """ Return a string that changes whenever the stored data of the
+        entry with the given index row changes, without reading the data.
+        Used by TieredPact to tell whether a local copy is stale.
+        """
+        if row["segment"] is not None:
+            # Records in segments are never modified in place.
+            return "segment:{}:{}".format(row["segment"], row["offset"])
+        elif row["blob"] is not None:
+            return "blob:" + row["blob"]
+        else:
+            st = os.stat(self.data_path(row))
+            return "file:{}:{}".format(st.st_size, st.st_mtime_ns)
+
+    def touch(self, row):
+        """ Update the last access time of the entry with this index row, if
+        it's older than access_resolution. Does nothing in read-only mode.
+        """
+        if self.readonly:
+            return
+        now = time.time()
+        accessed = row["accessed"]
+        if accessed is None or now - accessed > type(self).access_resolution:
+            with self.index as conn:
+                conn.execute(
+                    "UPDATE entries SET accessed = ?"
+                    " WHERE name = ? AND key = ?",
+                    (now, row["name"], row["key"]),
+                )
+        return
+
+    def delete(self, name, d, **kwargs):
+        """ Delete the entry for name and d, both its files and its entry in
+        the index. Returns whether there was such an entry.
+        """
+        d = self.update_dict(d, **kwargs)
+        row = self.lookup(name, d)
+        if row is None:
+            return False
+        self.delete_rows([row])
+        return True
+
+    def delete_rows(self, rows):
+        """ Delete the entries with the given index rows. The entries are
+        removed from the index first, so that no-one finds an entry whose
+        files are partially gone.
+        """
+        self.check_writable()
+        tombstones = []
+        with self.index as conn:
+            for row in rows:
+                args = (row["name"], row["key"])
+                old = conn.execute(
+                    "SELECT blob, pars, segment FROM entries"
+                    " WHERE name = ? AND key = ?",
+                    args,
+                ).fetchone()
+                if old is None:
+                    continue
+                if old["blob"] is not None:
+                    self.decref_blob(conn, old["blob"])
+                if self.cache is not None:
+                    d = pickle.loads(old["pars"])
+                    self.cache.invalidate(self.cache_key(row["name"], d))
+                conn.execute(
+                    "DELETE FROM entries WHERE name = ? AND key = ?", args
+                )
+                conn.execute(
+                    "DELETE FROM pars WHERE name = ? AND key = ?", args
+                )
+                if old["segment"] is not None:
+                    header = {"name": row["name"], "key": row["key"]}
+                    tombstones.append({"record": (pickle.dumps(header), b"")})
+        if tombstones:
+            with lock_file(self.packlockpath):
+                self.append_records(tombstones)
+        for row in rows:
+            paths = self.entry_paths(row["filename"])
+            for path in paths:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            self.prune_dirs(os.path.dirname(paths[0]))
+            logging.info("Deleted {}".format(row["filename"]))
+        return
+
+    def log_path(self, name, d):
+        return self.generate_path(name, d, extension=".log")
+
+    def lease_path(self, name, d):
+        if self.readonly:
+            return None
+        key = self.generate_key(d)
+        return self.folder + "leases/" + name + "_" + key + ".lease"
+
+    def cache_key(self, name, d):
+        return (os.path.abspath(self.folder), name, self.generate_key(d))
+
+    # # # The index
+
+    @property
+    def index(self):
+        """ The SQLite connection to the index of this thread, opened on
+        first use.
+        """
+        conn = getattr(self._local, "index", None)
+        if conn is None:
+            conn = self.open_index()
+            self._local.index = conn
+        return conn
+
+    def check_writable(self):
+        if self.readonly:
+            msg = "{} is opened read-only.".format(self.folder)
+            raise PermissionError(msg)
+        return
+
+    def open_index(self):
+        if self.readonly:
+            return self.open_readonly_index()
+        os.makedirs(self.folder, exist_ok=True)
+        # IMMEDIATE makes every write transaction take the write lock right
+        # away, rather than upgrading a read lock later, which could fail with
+        # concurrent writers.
+        conn = sqlite3.connect(
+            self.indexpath, timeout=60, isolation_level="IMMEDIATE"
+        )
+        conn.row_factory = sqlite3.Row
+        if not self.index_is_current(conn):
+            self.reconstruct_index(conn=conn, only_if_outdated=True)
+        return conn
+
+    def open_readonly_index(self):
+        """ Return an in-memory copy of the index. The file is opened as
+        immutable, so SQLite doesn't take any locks. If the index is missing
+        or out of date, the copy is built from the files in the folder.
+        """
+        conn = sqlite3.connect(":memory:", isolation_level="IMMEDIATE")
+        conn.row_factory = sqlite3.Row
+        if os.path.exists(self.indexpath):
+            uri = "file:{}?mode=ro&immutable=1".format(
+                urllib.parse.quote(os.path.abspath(self.indexpath))
+            )
+            disk = sqlite3.connect(uri, uri=True)
+            try:
+                disk.backup(conn)
+            finally:
+                disk.close()
+        if not self.index_is_current(conn):
+            msg = "Index of {} is out of date, building it in memory."
+            logging.warning(msg.format(self.folder))
+            rows = self.scan_index_rows()
+            with conn:
+                self.create_index_tables(conn)
+                self.insert_index_rows(conn, rows)
+        return conn
+
+    @property
+    def manifest(self):
+        """ The snapshot manifest of the folder, as written by
+        write_manifest, or None if there isn't one. Only used in read-only
+        mode, and read when first needed.
+        """
+        if self._manifest is None and os.path.exists(self.manifestpath):
+            with open(self.manifestpath, "r") as f:
+                self._manifest = json.load(f)
+        return self._manifest
+
+    def write_manifest(self):
+        """ Write a snapshot manifest of the folder, that records the
+        entry_token of every entry, for read-only Pacts to check entries
+        against. Returns the number of entries.
+        """
+        self.check_writable()
+        entries = collections.defaultdict(dict)
+        rows = self.index.execute("SELECT * FROM entries").fetchall()
+        for row in rows:
+            entries[row["name"]][row["key"]] = self.entry_token(row)
+        manifest = {"created": time.time(), "entries": entries}
+        with atomic_write(self.manifestpath, "w") as f:
+            json.dump(manifest, f)
+        logging.info(
+            "Wrote a manifest of {} entries to {}".format(
+                len(rows), self.manifestpath
+            )
+        )
+        return len(rows)
+
+    def check_manifest(self, row):
+        """ Raise an error if the entry with this index row isn't in the
+        snapshot manifest, or has changed since it was written.
+        """
+        token = self.manifest["entries"].get(row["name"], {}).get(row["key"])
+        if token is None:
+            msg = "{} is not in the snapshot manifest.".format(row["filename"])
+            raise FileNotFoundError(msg)
+        if token != self.entry_token(row):
+            msg = "{} has changed since the snapshot.".format(row["filename"])
+            raise ValueError(msg)
+        return
+
+    def validate_manifest(self):
+        """ Check all the entries against the snapshot manifest, and return
+        a list of the filenames of the ones that are missing from it, have
+        changed since, or have been deleted since. The list is also logged.
+        """
+        if self.manifest is None:
+            msg = "No manifest in {}".format(self.folder)
+            raise FileNotFoundError(msg)
+        bad = []
+        seen = set()
+        rows = self.index.execute("SELECT * FROM entries").fetchall()
+        for row in rows:
+            seen.add((row["name"], row["key"]))
+            try:
+                self.check_manifest(row)
+            except (FileNotFoundError, ValueError) as e:
+                logging.warning(str(e))
+                bad.append(row["filename"])
+        for name, keys in self.manifest["entries"].items():
+            for key in keys:
+                if (name, key) not in seen:
+                    logging.warning(
+                        "{} {} has been deleted.".format(name, key)
+                    )
+                    bad.append(name + "_" + key)
+        logging.info(
+            "{} of {} entries in {} don't match the manifest.".format(
+                len(bad), len(rows), self.folder
+            )
+        )
+        return bad
+
+    def index_is_current(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        return version == type(self).index_version
+
+    def create_index_tables(self, conn):
+        """ Create the tables of the index, dropping any old ones. Should be
+        called within a transaction.
+        """
+        conn.execute("DROP TABLE IF EXISTS entries")
+        conn.execute("DROP TABLE IF EXISTS pars")
+        conn.execute("DROP TABLE IF EXISTS blobs")
+        # Settings of the folder, that aren't lost when the index is rebuilt.
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT)"
+        )
+        conn.execute(
+            "CREATE TABLE entries ("
+            " name TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " filename TEXT NOT NULL,"
+            " pars BLOB NOT NULL,"
+            " codec TEXT NOT NULL,"
+            " compression TEXT,"
+            " size INTEGER,"
+            " accessed REAL,"
+            " cost REAL,"
+            " blob TEXT,"
+            " segment TEXT,"
+            " offset INTEGER,"
+            " length INTEGER,"
+            " checksum TEXT,"
+            " PRIMARY KEY (name, key))"
+        )
+        # One row for every parameter of every entry, for queries.
+        conn.execute(
+            "CREATE TABLE pars ("
+            " name TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " par TEXT NOT NULL,"
+            " num REAL,"
+            " text TEXT,"
+            " PRIMARY KEY (name, key, par))"
+        )
+        conn.execute(
+            "CREATE TABLE blobs ("
+            " hash TEXT PRIMARY KEY,"
+            " refs INTEGER NOT NULL,"
+            " size INTEGER NOT NULL)"
+        )
+        conn.execute("CREATE INDEX pars_num ON pars (name, par, num, key)")
+        conn.execute("CREATE INDEX pars_text ON pars (name, par, text, key)")
+        conn.execute(
+            "PRAGMA user_version = {:d}".format(type(self).index_version)
+        )
+        return
+
+    def close(self):
+        """ Close the connection to the index of this thread, if open. """
+        conn = getattr(self._local, "index", None)
+        if conn is not None:
+            conn.close()
+            self._local.index = None
+        return
+
+    def lookup(self, name, d):
+        """ Return the index row for name and d, or None if there is no such
+        entry. Entries stored with the legacy hash of d are also found.
+        """
+        sql = "SELECT * FROM entries WHERE name = ? AND key = ?"
+        key = self.generate_key(d)
+        row = self.index.execute(sql, (name, key)).fetchone()
+        if row is None and d:
+            key = self.generate_key(d, legacy=True)
+            row = self.index.execute(sql, (name, key)).fetchone()
+        return row
+
+    def index_row(self, name, d, filename, key=None, **kwargs):
+        """ Return a dictionary with the values of entry_columns for an
+        entry. kwargs give the values of the remaining columns.
+        """
+        if key is None:
+            key = self.generate_key(d)
+        row = dict(name=name, key=key, filename=filename, pars=d, **kwargs)
+        return row
+
+    def insert_index_rows(self, conn, rows):
+        """ Insert rows, as given by index_row, into the index. Should be
+        called within a transaction.
+        """
+        cls = type(self)
+        sql = "INSERT OR REPLACE INTO entries VALUES ({})".format(
+            ",".join("?" * len(cls.entry_columns))
+        )
+        for row in rows:
+            name, key, d = row["name"], row["key"], row["pars"]
+            values = [row.get(c, None) for c in cls.entry_columns]
+            values[cls.entry_columns.index("pars")] = pickle.dumps(d)
+            old = conn.execute(
+                "SELECT filename, blob, segment FROM entries"
+                " WHERE name = ? AND key = ?",
+                (name, key),
+            ).fetchone()
+            if row.get("blob") is not None:
+                self.incref_blob(conn, row["blob"], row.get("tmppath"))
+            if old is not None and old["blob"] is not None:
+                self.decref_blob(conn, old["blob"])
+            if (
+                old is not None
+                and old["segment"] is None
+                and row.get("segment") is not None
+            ):
+                # A packed entry replaces one with files of its own. Remove
+                # the files, but not the log, which is the new entry's too.
+                paths = self.entry_paths(old["filename"])
+                for path in paths[:2]:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(path)
+            conn.execute(
+                "DELETE FROM pars WHERE name = ? AND key = ?", (name, key)
+            )
+            conn.execute(sql, values)
+            conn.executemany(
+                "INSERT INTO pars VALUES (?,?,?,?,?)",
+                ((name, key, k) + cls.par_to_columns(v) for k, v in d.items()),
+            )
+        return
+
+    def incref_blob(self, conn, blob, tmppath=None):
+        """ Add a reference to a blob. If it's a new blob, its contents are
+        moved into place from tmppath, and if it's not, tmppath is removed.
+        Should be called within a transaction, which makes sure that no-one
+        else is adding or removing the same blob at the same time.
+        """
+        path = self.blob_path(blob)
+        cursor = conn.execute(
+            "UPDATE blobs SET refs = refs + 1 WHERE hash = ?", (blob,)
+        )
+        if cursor.rowcount == 0:
+            if tmppath is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmppath, path)
+            conn.execute(
+                "INSERT INTO blobs VALUES (?, 1, ?)",
+                (blob, os.path.getsize(path)),
+            )
+        elif tmppath is not None:
+            os.remove(tmppath)
+            logging.info("Deduplicated against blob {}".format(blob))
+        return
+
+    def decref_blob(self, conn, blob):
+        """ Remove a reference to a blob, deleting it if it was the last
+        one. Should be called within a transaction.
+        """
+        conn.execute(
+            "UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (blob,)
+        )
+        row = conn.execute(
+            "SELECT refs FROM blobs WHERE hash = ?", (blob,)
+        ).fetchone()
+        if row is not None and row["refs"] <= 0:
+            conn.execute("DELETE FROM blobs WHERE hash = ?", (blob,))
+            path = self.blob_path(blob)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            self.prune_dirs(os.path.dirname(path))
+        return
+
+    def prune_dirs(self, dirpath):
+        """ Remove dirpath and its parents, up to but not including the
+        folder, as long as they are empty. Used to clean up subfolders of
+        the sharded layout and the blobs.
+        """
+        folder = os.path.abspath(self.folder)
+        dirpath = os.path.abspath(dirpath)
+        while dirpath.startswith(folder) and dirpath != folder:
+            try:
+                os.rmdir(dirpath)
+            except OSError:
+                break
+            dirpath = os.path.dirname(dirpath)
+        return
+
+    def query(self, name, **partial_pars):
+        sql = "SELECT pars, filename, segment FROM entries WHERE name = ?"
+        cond, args = type(self).pars_filter(name, partial_pars)
+        sql += cond
+        args = [name] + args
+        res = []
+        for row in self.index.execute(sql, args):
+            if row["segment"] is None:
+                path = self.generate_path(filename=row["filename"])
+            else:
+                # Packed entries are records in a segment, with no file.
+                path = None
+            res.append((pickle.loads(row["pars"]), path))
+        return res
+
+    def reconstruct_index(self, conn=None, only_if_outdated=False):
+        """ Rebuild the index from scratch, based on the YAML files in the
+        folder. Only entries for which the data file is also present are
+        included. If only_if_outdated is True, the index is left alone if it
+        already has the current schema, which may happen if another process
+        rebuilt it while we were waiting for the lock.
+        """
+        self.check_writable()
+        if conn is None:
+            conn = self.index
+        with lock_file(self.lockpath):
+            if only_if_outdated and self.index_is_current(conn):
+                return
+            rows = self.scan_index_rows()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                self.create_index_tables(conn)
+                self.insert_index_rows(conn, rows)
+        logging.info(
+            "Reconstructed index {} with {} entries.".format(
+                self.indexpath, len(rows)
+            )
+        )
+        return
+
+    def scan_index_rows(self):
+        """ Return index rows for all the entries found in the folder. An
+        entry with files of its own takes precedence over a packed one.
+        """
+        rows = self.scan_segment_rows()
+        for dirpath, dirnames, filenames in os.walk(self.folder):
+            if os.path.normpath(dirpath) == os.path.normpath(self.folder):
+                # These hold no entries of their own. In particular the
+                # entries in quarantine must not come back.
+                dirnames[:] = [
+                    d for d in dirnames if d not in type(self).special_folders
+                ]
+            filenames = set(filenames)
+            for yamlname in filenames:
+                stem, ext = os.path.splitext(yamlname)
+                if ext != ".yaml" or "_" not in stem:
+                    continue
+                datafilename = stem + ".p"
+                if datafilename not in filenames:
+                    continue
+                name, key = stem.rsplit("_", 1)
+                yamlpath = os.path.join(dirpath, yamlname)
+                try:
+                    d, checksum, length = self.read_pars_file(yamlpath)
+                except (yaml.YAMLError, OSError, ValueError) as e:
+                    msg = "Skipping unreadable {} in reconstruct_index: {}"
+                    logging.warning(msg.format(yamlpath, e))
+                    continue
+                if not isinstance(d, dict):
+                    continue
+                datapath = os.path.join(dirpath, datafilename)
+                filename = os.path.relpath(datapath, self.folder)
+                size = self.entry_size(filename)
+                blob = read_blob_pointer(datapath)
+                if blob is not None:
+                    datapath = self.blob_path(blob)
+                    if not os.path.isfile(datapath):
+                        msg = "Skipping {} in reconstruct_index, blob missing."
+                        logging.warning(msg.format(filename))
+                        continue
+                    size += os.path.getsize(datapath)
+                codec, compression = pactcodecs.detect_format(datapath)
+                row = self.index_row(
+                    name,
+                    d,
+                    filename,
+                    key=key,
+                    codec=codec,
+                    compression=compression,
+                    size=size,
+                    accessed=os.stat(datapath).st_atime,
+                    blob=blob,
+                    length=length,
+                    checksum=checksum,
+                )
+                rows[(name, key)] = row
+        return list(rows.values())
+
+    def scan_segment_rows(self):
+        """ Return a dictionary of index rows for all the packed entries, by
+        (name, key). Later records replace earlier ones, and tombstones
+        remove them.
+        """
+        rows = {}
+        for segment in self.list_segments():
+            accessed = os.stat(self.segment_path(segment)).st_atime
+            for header, offset, length in self.read_records(segment):
+                k = (header["name"], header["key"])
+                if "pars" not in header:
+                    rows.pop(k, None)
+                    continue
+                rows[k] = self.index_row(
+                    header["name"],
+                    header["pars"],
+                    header["filename"],
+                    key=header["key"],
+                    codec=header["codec"],
+                    compression=header["compression"],
+                    size=length,
+                    accessed=accessed,
+                    cost=header["cost"],
+                    segment=segment,
+                    offset=offset,
+                    length=length,
+                    checksum=header.get("checksum"),
+                )
+        return rows
+
+    def compact_segments(self):
+        """ Rewrite the segments with only the records of the entries that
+        still exist, dropping the ones that have been deleted or replaced.
+        Other processes can keep using the folder meanwhile, although
+        storing packed entries waits until the compaction is done. Returns
+        the number of bytes freed.
+        """
+        self.check_writable()
+        os.makedirs(self.segmentfolder, exist_ok=True)
+        with lock_file(self.packlockpath):
+            old_segments = self.list_segments()
+            if not old_segments:
+                return 0
+            old_size = sum(
+                os.path.getsize(self.segment_path(s)) for s in old_segments
+            )
+            rows = [
+                dict(row)
+                for row in self.index.execute(
+                    "SELECT * FROM entries WHERE segment IS NOT NULL"
+                    " ORDER BY segment, offset"
+                )
+            ]
+            # Write the new segments after the old ones, so that
+            # reconstruct_index gets things right even if we crash halfway.
+            # Starting with an empty segment makes append_records use it.
+            number = int(old_segments[-1][:-5]) + 1
+            open(self.segment_path("{:08d}.pack".format(number)), "ab").close()
+            batch = []
+            batch_size = 0
+            for row in rows:
+                with open(self.segment_path(row["segment"]), "rb") as f:
+                    f.seek(row["offset"])
+                    buf = f.read(row["length"])
+                header = {
+                    "name": row["name"],
+                    "key": row["key"],
+                    "filename": row["filename"],
+                    "pars": pickle.loads(row["pars"]),
+                    "codec": row["codec"],
+                    "compression": row["compression"],
+                    "cost": row["cost"],
+                    "checksum": row["checksum"],
+                }
+                row["record"] = (pickle.dumps(header), buf)
+                row["old"] = (row["segment"], row["offset"])
+                batch.append(row)
+                batch_size += len(buf)
+                if batch_size >= type(self).segment_size:
+                    self.append_records(batch)
+                    for r in batch:
+                        del r["record"]
+                    batch = []
+                    batch_size = 0
+            self.append_records(batch)
+            with self.index as conn:
+                conn.executemany(
+                    "UPDATE entries SET segment = ?, offset = ?"
+                    " WHERE name = ? AND key = ? AND segment = ?"
+                    " AND offset = ?",
+                    (
+                        (
+                            row["segment"],
+                            row["offset"],
+                            row["name"],
+                            row["key"],
+                        )
+                        + row["old"]
+                        for row in rows
+                    ),
+                )
+            for segment in old_segments:
+                os.remove(self.segment_path(segment))
+            new_size = sum(
+                os.path.getsize(self.segment_path(s))
+                for s in self.list_segments()
+            )
+        freed = old_size - new_size
+        logging.info(
+            "Compacted the segments of {}, freeing {} bytes.".format(
+                self.folder, freed
+            )
+        )
+        return freed
+
+    def benchmark_compression(self, compressions=None, names=None, sample=10):
+        """ Try compressing a random sample of the stored entries with each
+        of the given compressions, and report how well each one does. names
+        can be used to restrict to some names of data, and compressions
+        defaults to all the ones in pactcodecs, and no compression.
+
+        Returns a list of dictionaries, one for each compression, with the
+        total uncompressed and compressed sizes in bytes, their ratio, and
+        the encoding and decoding throughputs in MB/s of uncompressed data.
+        The results are also logged. Decoding uncompressed data only
+        memory-maps it, so its throughput means little.
+        """
+        if compressions is None:
+            compressions = [None] + sorted(pactcodecs.compressions)
+        rows = self.index.execute("SELECT * FROM entries").fetchall()
+        if names is not None:
+            rows = [row for row in rows if row["name"] in names]
+        rows = random.sample(rows, min(sample, len(rows)))
+        datas = []
+        for row in rows:
+            datas.append((row["codec"], self.load_row(row)))
+
+        report = []
+        for compression in compressions:
+            raw_size = 0
+            size = 0
+            encode_time = 0.0
+            decode_time = 0.0
+            for codec, data in datas:
+                buf = io.BytesIO()
+                pactcodecs.dump(data, buf, codec)
+                raw_size += buf.tell()
+                buf = io.BytesIO()
+                start = time.perf_counter()
+                pactcodecs.dump(data, buf, codec, compression)
+                encode_time += time.perf_counter() - start
+                size += buf.tell()
+                buf = buf.getbuffer()
+                start = time.perf_counter()
+                pactcodecs.loads(buf)
+                decode_time += time.perf_counter() - start
+                del buf
+            report.append(
+                {
+                    "compression": compression,
+                    "entries": len(datas),
+                    "raw_size": raw_size,
+                    "size": size,
+                    "ratio": raw_size / size if size else float("nan"),
+                    "encode_MBps": raw_size / 1e6 / encode_time
+                    if encode_time
+                    else float("inf"),
+                    "decode_MBps": raw_size / 1e6 / decode_time
+                    if decode_time
+                    else float("inf"),
+                }
+            )
+
+        msg = "Compression benchmark on {} entries of {}:".format(
+            len(datas), self.folder
+        )
+        for r in report:
+            msg += (
+                "\n{compression!s:>14}: ratio {ratio:.3f},"
+                " encode {encode_MBps:.1f} MB/s,"
+                " decode {decode_MBps:.1f} MB/s"
+            ).format(**r)
+        logging.info(msg)
+        return report
+
+    def migrate_layout(self, layout):
+        """ Move all the files in the folder to the given layout, "flat" or
+        "sharded". New files are written in the new layout right away. The
+        folder can be used by other processes during the migration: each file
+        is hard linked to its new place before the index is updated, and only
+        then removed from the old one, so that an entry can always be found.
+        """
+        self.check_writable()
+        if layout not in ("flat", "sharded"):
+            raise ValueError("Unknown layout: {}".format(layout))
+        with self.index as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('layout', ?)", (layout,)
+            )
+        self._layout = layout
+        rows = self.index.execute(
+            "SELECT name, key, filename FROM entries"
+        ).fetchall()
+        moved = 0
+        for row in rows:
+            stem, extension = os.path.splitext(row["filename"])
+            filename = type(self).key_to_filename(
+                row["name"], row["key"], extension, layout
+            )
+            if filename == row["filename"]:
+                continue
+            oldpaths = []
+            for oldpath, newpath in zip(
+                self.entry_paths(row["filename"]), self.entry_paths(filename)
+            ):
+                if not os.path.exists(oldpath):
+                    continue
+                os.makedirs(os.path.dirname(newpath), exist_ok=True)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(newpath)
+                try:
+                    os.link(oldpath, newpath)
+                    oldpaths.append(oldpath)
+                except OSError:
+                    os.replace(oldpath, newpath)
+            with self.index as conn:
+                conn.execute(
+                    "UPDATE entries SET filename = ?"
+                    " WHERE name = ? AND key = ?",
+                    (filename, row["name"], row["key"]),
+                )
+            for oldpath in oldpaths:
+                os.remove(oldpath)
+            olddir = os.path.dirname(self.generate_path(filename=stem))
+            self.prune_dirs(olddir)
+            moved += 1
+        logging.info(
+            "Moved {} entries of {} to the {} layout.".format(
+                moved, self.folder, layout
+            )
+        )
+        return moved
+
+    def gc(self, quota, dry_run=False):
+        """ Delete entries until the total size of the entries in the folder
+        is at most quota bytes. Entries are deleted in the order of
+            size * time since last access / cost,
+        so that large entries that haven't been used for a while and are
+        cheap to generate again go first. For entries with unknown cost the
+        median of the known costs is used. If dry_run is True, nothing is
+        deleted. If packed entries are deleted, the segments are compacted to
+        free their space. With dedup, a blob shared by several entries is
+        counted once, and its space is only freed along with the last entry
+        that uses it.
+
+        Returns a list of dictionaries describing the deleted entries, or the
+        ones that would be deleted, in the order of deletion, where size is
+        the number of bytes that deleting the entry frees. The list is also
+        logged.
+        """
+        rows = self.index.execute(
+            "SELECT name, key, filename, size, accessed, cost, segment, blob"
+            " FROM entries"
+        ).fetchall()
+        # The size of an entry with a blob includes the blob.
+        blob_sizes = {
+            row["hash"]: row["size"]
+            for row in self.index.execute("SELECT hash, size FROM blobs")
+        }
+        blob_refs = collections.Counter(
+            row["blob"] for row in rows if row["blob"] is not None
+        )
+
+        def own_size(row):
+            size = row["size"] or 0
+            if row["blob"] is not None:
+                size -= blob_sizes.get(row["blob"], 0)
+            return size
+
+        total = sum(own_size(row) for row in rows)
+        total += sum(blob_sizes.get(blob, 0) for blob in blob_refs)
+        costs = sorted(row["cost"] for row in rows if row["cost"] is not None)
+        default_cost = costs[len(costs) // 2] if costs else 1.0
+        now = time.time()
+
+        def score(row):
+            age = max(now - (row["accessed"] or 0), 1.0)
+            cost = row["cost"] if row["cost"] is not None else default_cost
+            # The 1e-3 keeps entries that took no time at all from dominating.
+            return (row["size"] or 0) * age / (cost + 1e-3)
+
+        rows = sorted(rows, key=score, reverse=True)
+        evict = []
+        report = []
+        for row in rows:
+            if total <= quota:
+                break
+            size = own_size(row)
+            if row["blob"] is not None:
+                blob_refs[row["blob"]] -= 1
+                if blob_refs[row["blob"]] == 0:
+                    size += blob_sizes.get(row["blob"], 0)
+            evict.append(row)
+            report.append(
+                {
+                    "name": row["name"],
+                    "filename": row["filename"],
+                    "size": size,
+                    "age": now - (row["accessed"] or 0),
+                    "cost": row["cost"],
+                    "score": score(row),
+                }
+            )
+            total -= size
+        freed = sum(r["size"] for r in report)
+        if not dry_run:
+            self.delete_rows(evict)
+            packed = [row for row in evict if row["segment"] is not None]
+            if packed:
+                # The records of packed entries take space until the
+                # segments are compacted.
+                freed -= sum(row["size"] or 0 for row in packed)
+                freed += self.compact_segments()
+        msg = "{} {} entries, {} bytes, from {}, leaving {} bytes.".format(
+            "Would delete" if dry_run else "Deleted",
+            len(evict),
+            freed,
+            self.folder,
+            total,
+        )
+        for r in report:
+            msg += (
+                "\n{filename}: {size} bytes, last used {age:.0f} s ago,"
+                " cost {cost} s"
+            ).format(**r)
+        logging.info(msg)
+        return report
+
+    def check_row(self, row, check_hash=True):
+        """ Return a string describing what is wrong with the data of the
+        entry with this index row, or None if nothing is. Entries without a
+        recorded length and checksum are only checked to exist.
+        """
+        path = self.data_path(row)
+        try:
+            if row["segment"] is not None:
+                buf = self.read_packed(row)
+                if len(buf) != row["length"]:
+                    raise CorruptEntryError("Cut short.")
+                if check_hash:
+                    self.check_checksum(row, hashlib.sha256(buf).hexdigest())
+            else:
+                self.check_length(row, path)
+                if check_hash:
+                    self.check_checksum(row, file_digest(path))
+        except (OSError, CorruptEntryError) as e:
+            return str(e)
+        return None
+
+    def read_packed(self, row):
+        """ Return the bytes of the data of the packed entry with this index
+        row.
+        """
+        with open(self.data_path(row), "rb") as f:
+            f.seek(row["offset"])
+            return f.read(row["length"])
+
+    def data_checksum(self, row):
+        """ Return the SHA-256 checksum of the data of the entry with this
+        index row, computed from the data rather than taken from the index.
+        """
+        if row["segment"] is not None:
+            return hashlib.sha256(self.read_packed(row)).hexdigest()
+        else:
+            return file_digest(self.data_path(row))
+
+    def verify_all(self, check_hash=True, quarantine=True, max_workers=8):
+        """ Check the data of every entry against its recorded length and,
+        if check_hash is True, checksum, using a pool of max_workers threads.
+        If quarantine is True, corrupt entries are moved to the subfolder
+        quarantine, and removed from the index.
+
+        Returns a dictionary with the number of entries, the number of them
+        that had no checksum to check against, and a list of pairs
+        (filename, problem) of the corrupt ones. The report is also logged.
+        """
+        rows = self.index.execute("SELECT * FROM entries").fetchall()
+        # Check every blob just once.
+        blobs = {}
+        for row in rows:
+            if row["blob"] is not None:
+                blobs.setdefault(row["blob"], row)
+        unique = [row for row in rows if row["blob"] is None]
+        unique += list(blobs.values())
+
+        def check(row):
+            return self.check_row(row, check_hash=check_hash)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            problems = dict(zip(map(id, unique), executor.map(check, unique)))
+        bad_blobs = {
+            row["blob"]
+            for row in blobs.values()
+            if problems[id(row)] is not None
+        }
+        corrupt = []
+        for row in rows:
+            if row["blob"] is not None:
+                problem = problems[id(blobs[row["blob"]])]
+            else:
+                problem = problems[id(row)]
+            if problem is not None:
+                corrupt.append((row, problem))
+        report = {
+            "entries": len(rows),
+            "unchecked": sum(1 for row in rows if row["checksum"] is None),
+            "corrupt": [
+                (row["filename"], problem) for row, problem in corrupt
+            ],
+        }
+        msg = "{} of {} entries in {} are corrupt, {} had no checksum.".format(
+            len(corrupt), len(rows), self.folder, report["unchecked"]
+        )
+        for filename, problem in report["corrupt"]:
+            msg += "\n{}: {}".format(filename, problem)
+        logging.info(msg)
+        if quarantine and corrupt:
+            self.quarantine_rows([row for row, problem in corrupt])
+        if bad_blobs:
+            logging.info("Corrupt blobs: {}".format(", ".join(bad_blobs)))
+        return report
+
+    def quarantine(self, name, d, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        row = self.lookup(name, d)
+        if row is None:
+            return False
+        self.quarantine_rows([row])
+        return True
+
+    def quarantine_rows(self, rows):
+        """ Move whatever there is of the files of the entries with the given
+        index rows to the subfolder quarantine, and delete the entries.
+        """
+        self.check_writable()
+        qfolder = self.folder + "quarantine/"
+        for row in rows:
+            paths = self.entry_paths(row["filename"])
+            qpaths = [qfolder + os.path.basename(path) for path in paths]
+            os.makedirs(qfolder, exist_ok=True)
+            moves = list(zip(paths, qpaths))
+            if row["segment"] is not None or row["blob"] is not None:
+                # The data isn't in a file of its own, so copy it. The
+                # pointer file of a blob is removed by delete_rows.
+                moves = moves[1:]
+                with contextlib.suppress(OSError):
+                    with open(self.data_path(row), "rb") as src:
+                        with open(qpaths[0], "wb") as f:
+                            if row["segment"] is not None:
+                                src.seek(row["offset"])
+                                f.write(src.read(row["length"]))
+                            else:
+                                shutil.copyfileobj(src, f)
+            for path, qpath in moves:
+                with contextlib.suppress(FileNotFoundError):
+                    os.replace(path, qpath)
+            logging.warning("Moved {} to {}".format(row["filename"], qfolder))
+        self.delete_rows(rows)
+        return
+
+    def sync(self, dest, max_workers=8, delete=False, batch_size=1000):
+        """ Copy the entries of this Pact to the Pact dest, or a Pact in the
+        folder dest, skipping the ones that dest already has with the same
+        checksum. Checksums missing from either index are computed from the
+        data. The data is copied as it is, without decoding it, by a pool of
+        max_workers threads, and added to the index of dest every
+        batch_size entries. An interrupted sync can thus be resumed by
+        running it again, and only the last batch is copied again. If delete
+        is True, entries of dest that this Pact doesn't have are deleted.
+
+        Returns a dictionary with the numbers of entries copied, skipped
+        because they were up to date, and deleted. It is also logged.
+        """
+        if not isinstance(dest, Pact):
+            dest = Pact(dest)
+        dest.check_writable()
+        rows = self.index.execute("SELECT * FROM entries").fetchall()
+        dest_rows = {
+            (row["name"], row["key"]): row
+            for row in dest.index.execute("SELECT * FROM entries")
+        }
+        # Find the layout before starting the threads, see store_many.
+        dest.layout
+
+        def copy_row(row):
+            old = dest_rows.get((row["name"], row["key"]))
+            if old is not None and self.same_data(row, dest, old):
+                return None
+            return dest.import_row(self, row)
+
+        report = {"copied": 0, "skipped": 0, "deleted": 0}
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            for i in range(0, len(rows), batch_size):
+                batch = rows[i : i + batch_size]
+                new_rows = [
+                    row
+                    for row in executor.map(copy_row, batch)
+                    if row is not None
+                ]
+                dest.commit_rows(new_rows)
+                if dest.cache is not None:
+                    for row in new_rows:
+                        key = dest.cache_key(row["name"], row["pars"])
+                        dest.cache.invalidate(key)
+                report["copied"] += len(new_rows)
+                report["skipped"] += len(batch) - len(new_rows)
+                logging.info(
+                    "Synced {} of {} entries from {} to {}.".format(
+                        i + len(batch), len(rows), self.folder, dest.folder
+                    )
+                )
+        if delete:
+            keys = {(row["name"], row["key"]) for row in rows}
+            extra = [row for k, row in dest_rows.items() if k not in keys]
+            dest.delete_rows(extra)
+            report["deleted"] = len(extra)
+        logging.info(
+            "Synced {} to {}: {copied} copied, {skipped} up to date,"
+            " {deleted} deleted.".format(self.folder, dest.folder, **report)
+        )
+        return report
+
+    def same_data(self, row, other, other_row):
+        """ Return whether the entry with this index row has the same data
+        as the entry of the Pact other with other_row.
+        """
+        if (
+            row["length"] is not None
+            and other_row["length"] is not None
+            and row["length"] != other_row["length"]
+        ):
+            return False
+        try:
+            checksum = row["checksum"] or self.data_checksum(row)
+            other_checksum = other_row["checksum"] or other.data_checksum(
+                other_row
+            )
+        except OSError:
+            return False
+        return checksum == other_checksum
+
+    def import_row(self, src, row):
+        """ Copy the entry of the Pact src with the given index row to this
+        Pact, keeping its key and the way it's stored, and return the row
+        for the index, for commit_rows. See write_entry.
+        """
+        name = row["name"]
+        d = pickle.loads(row["pars"])
+        stem, extension = os.path.splitext(row["filename"])
+        filename = type(self).key_to_filename(
+            name, row["key"], extension, self.layout
+        )
+        checksum = row["checksum"] or src.data_checksum(row)
+        length = row["length"]
+        if length is None:
+            length = os.path.getsize(src.data_path(row))
+        fields = dict(
+            codec=row["codec"],
+            compression=row["compression"],
+            accessed=row["accessed"],
+            cost=row["cost"],
+            length=length,
+            checksum=checksum,
+        )
+        if row["segment"] is not None:
+            buf = src.read_packed(row)
+            newrow = self.index_row(
+                name, d, filename, key=row["key"], size=len(buf), **fields
+            )
+            header = {
+                "name": name,
+                "key": row["key"],
+                "filename": filename,
+                "pars": d,
+                "codec": row["codec"],
+                "compression": row["compression"],
+                "cost": row["cost"],
+                "checksum": checksum,
+            }
+            newrow["record"] = (pickle.dumps(header), buf)
+            self.import_sidecars(src, row, filename)
+            return newrow
+
+        paths = self.entry_paths(filename)
+        os.makedirs(os.path.dirname(paths[0]), exist_ok=True)
+        tmppath = None
+        if row["blob"] is not None:
+            if not os.path.exists(self.blob_path(row["blob"])):
+                blobfolder = self.folder + "blobs/"
+                os.makedirs(blobfolder, exist_ok=True)
+                fd, tmppath = mkstemp(blobfolder)
+                with os.fdopen(fd, "wb") as f:
+                    with open(src.data_path(row), "rb") as srcf:
+                        shutil.copyfileobj(srcf, f, 2 ** 24)
+                    f.flush()
+                    os.fsync(f.fileno())
+            with atomic_write(paths[0], "wb") as f:
+                f.write(blob_pointer_magic + row["blob"].encode("ascii"))
+        else:
+            with atomic_write(paths[0], "wb") as f:
+                with open(src.data_path(row), "rb") as srcf:
+                    shutil.copyfileobj(srcf, f, 2 ** 24)
+        type(self).write_pars_file(paths[1], d, checksum, length)
+        self.import_sidecars(src, row, filename)
+        size = self.entry_size(filename)
+        if row["blob"] is not None:
+            size += length
+        newrow = self.index_row(
+            name,
+            d,
+            filename,
+            key=row["key"],
+            size=size,
+            blob=row["blob"],
+            **fields
+        )
+        newrow["tmppath"] = tmppath
+        return newrow
+
+    def import_sidecars(self, src, row, filename):
+        """ Copy the sidecar files other than the pars file, such as the log,
+        of the entry of src with the given index row, to go with filename.
+        Packed entries can have these too.
+        """
+        paths = self.entry_paths(filename)
+        src_paths = src.entry_paths(row["filename"])
+        for src_path, path in zip(src_paths[2:], paths[2:]):
+            with contextlib.suppress(FileNotFoundError):
+                with open(src_path, "rb") as srcf:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with atomic_write(path, "wb") as f:
+                        shutil.copyfileobj(srcf, f)
+        return
+
+    def key_merge_report(self):
+        """ Return a report of the entries in the index that are stored
+        under a legacy hash, and of the ones that would be merged, because
+        their dictionaries have the same canonical form. The report is a
+        dictionary with the total number of entries, the number of them with
+        legacy hashes, the number of entries that would merge with another
+        one, and a list of the groups of filenames that would merge. The
+        report is also logged.
+        """
+        rows = self.index.execute(
+            "SELECT name, key, filename, pars FROM entries"
+        ).fetchall()
+        groups = collections.defaultdict(list)
+        legacy = 0
+        for row in rows:
+            key = self.generate_key(pickle.loads(row["pars"]))
+            if key != row["key"]:
+                legacy += 1
+            groups[(row["name"], key)].append(row["filename"])
+        merging = [g for g in groups.values() if len(g) > 1]
+        report = {
+            "entries": len(rows),
+            "legacy": legacy,
+            "merging": sum(len(g) for g in merging),
+            "groups": merging,
+        }
+        msg = (
+            "{entries} entries in {folder}, {legacy} with legacy hashes."
+            " {merging} entries in {ngroups} groups would merge."
+        ).format(folder=self.folder, ngroups=len(merging), **report)
+        for g in merging:
+            msg += "\n" + ", ".join(g)
+        logging.info(msg)
+        return report
+
+
+def parse_size(string):
+    """ Parse a number of bytes, like 2000, 500M or 1.5T. """
+    units = {"K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+    string = string.strip().upper().rstrip("B")
+    if string and string[-1] in units:
+        return int(float(string[:-1]) * units[string[-1]])
+    return int(string)
+
+
+def main(argv=None):
+    """ A command line interface for maintaining Pact folders. Run
+    python -m tntools.pact --help for usage.
+    """
+    parser = argparse.ArgumentParser(
+        prog="python -m tntools.pact",
+        description="Maintenance tools for Pact databases.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    subparser = subparsers.add_parser(
+        "reconstruct", help="Rebuild the index from the stored files."
+    )
+    subparser.add_argument("folder")
+
+    subparser = subparsers.add_parser(
+        "migrate", help="Move the stored files to a different layout."
+    )
+    subparser.add_argument("folder")
+    subparser.add_argument("layout", choices=["flat", "sharded"])
+
+    subparser = subparsers.add_parser(
+        "benchmark", help="Benchmark compressions on a sample of entries."
+    )
+    subparser.add_argument("folder")
+    subparser.add_argument("--sample", type=int, default=10)
+    subparser.add_argument("--names", nargs="*", default=None)
+
+    subparser = subparsers.add_parser(
+        "gc", help="Delete entries until the folder fits in a quota."
+    )
+    subparser.add_argument("folder")
+    subparser.add_argument("quota", help="In bytes, or like 500M or 2T.")
+    subparser.add_argument("--dry-run", action="store_true")
+
+    subparser = subparsers.add_parser(
+        "keyreport",
+        help="Report entries with legacy hashes that would be merged.",
+    )
+    subparser.add_argument("folder")
+
+    subparser = subparsers.add_parser(
+        "compact", help="Rewrite the segments of packed entries."
+    )
+    subparser.add_argument("folder")
+
+    subparser = subparsers.add_parser(
+        "snapshot",
+        help="Write a manifest for read-only use, or check against one.",
+    )
+    subparser.add_argument("folder")
+    subparser.add_argument("--check", action="store_true")
+
+    subparser = subparsers.add_parser(
+        "verify",
+        help="Check all entries for corruption, and quarantine bad ones.",
+    )
+    subparser.add_argument("folder")
+    subparser.add_argument("--no-hash", action="store_true")
+    subparser.add_argument("--no-quarantine", action="store_true")
+    subparser.add_argument("--workers", type=int, default=8)
+
+    subparser = subparsers.add_parser(
+        "sync", help="Copy the entries that another folder is missing to it.",
+    )
+    subparser.add_argument("folder")
+    subparser.add_argument("dest")
+    subparser.add_argument("--workers", type=int, default=8)
+    subparser.add_argument("--delete", action="store_true")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    folder = os.path.join(args.folder, "")
+    readonly = args.command == "snapshot" and args.check
+    p = Pact(folder, readonly=readonly)
+    if args.command == "reconstruct":
+        p.reconstruct_index()
+    elif args.command == "migrate":
+        p.migrate_layout(args.layout)
+    elif args.command == "benchmark":
+        p.benchmark_compression(names=args.names, sample=args.sample)
+    elif args.command == "gc":
+        p.gc(parse_size(args.quota), dry_run=args.dry_run)
+    elif args.command == "keyreport":
+        p.key_merge_report()
+    elif args.command == "compact":
+        p.compact_segments()
+    elif args.command == "sync":
+        dest = Pact(os.path.join(args.dest, ""))
+        p.sync(dest, max_workers=args.workers, delete=args.delete)
+    elif args.command == "verify":
+        p.verify_all(
+            check_hash=not args.no_hash,
+            quarantine=not args.no_quarantine,
+            max_workers=args.workers,
+        )
+    elif args.command == "snapshot" and args.check:
+        p.validate_manifest()
+    elif args.command == "snapshot":
+        p.write_manifest()
+    return
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,498 @@
+"""Storage backends for Pact-like stores, other than the folder of files of
+pact.Pact itself. They all implement the interface of pact.PactBackend, so
+they can be used wherever a Pact is, for instance as the db argument of
+datadispenser.get_data.
+
+MemoryPact keeps everything in a dictionary in memory, and is meant for tests
+and benchmarks. Nothing is written to the disk.
+
+SQLitePact keeps everything, the data included, in a single SQLite file. This
+avoids creating several files per entry, which strains file systems with
+limits on the number of files, and makes copying the whole database from one
+machine to another a matter of copying one file, see SQLitePact.backup. The
+data is written with the same codecs and compressions as by Pact, see
+pactcodecs.py.
+
+TieredPact puts a local cache folder, say on a fast local disk or tmpfs, in
+front of a Pact on slow shared storage. Fetched entries are copied to the
+local folder, and later fetches read the local copy, as long as the entry in
+the shared Pact hasn't changed since. The local folder has a size cap, beyond
+which the least recently used copies are removed. Everything else, storing
+included, goes straight to the shared Pact.
+"""
+
+import contextlib
+import copy
+import io
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+from . import pactcodecs
+from .pact import Pact, PactBackend, CorruptEntryError, atomic_write
+
+
+class MemoryPact(PactBackend):
+    """ A backend that keeps data in memory. If copy is True, data is copied
+    when stored and when fetched, so that modifying fetched data doesn't
+    change what is stored, like with the other backends.
+    """
+
+    shared_between_processes = False
+
+    def __init__(self, copy=True):
+        self.copy = copy
+        # Keys are pairs (name, key), values pairs (pars, data).
+        self.entries = {}
+
+    def maybe_copy(self, data):
+        return copy.deepcopy(data) if self.copy else data
+
+    def exists(self, name, d, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        return (name, self.generate_key(d)) in self.entries
+
+    def fetch(self, name, d, lazy=False, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        try:
+            pars, data = self.entries[(name, self.generate_key(d))]
+        except KeyError:
+            msg = "No entry for {} {}".format(name, d)
+            raise FileNotFoundError(msg) from None
+        return self.maybe_copy(data)
+
+    def store(self, data, name, d, cost=None, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        key = self.generate_key(d)
+        self.entries[(name, key)] = (d, self.maybe_copy(data))
+        return
+
+    def delete(self, name, d, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        entry = self.entries.pop((name, self.generate_key(d)), None)
+        return entry is not None
+
+    def query(self, name, **partial_pars):
+        res = [
+            (copy.deepcopy(pars), None)
+            # A copy, since other threads may be storing meanwhile.
+            for (n, key), (pars, data) in list(self.entries.items())
+            if n == name and self.pars_match(pars, partial_pars)
+        ]
+        return res
+
+
+class SQLitePact(PactBackend):
+    """ A backend that keeps data in a single SQLite file at path.
+    native_arrays and compression are as for Pact. Several processes can use
+    the same file at the same time, SQLite's locking takes care of that.
+    """
+
+    # Bump this whenever the schema changes. Unlike the index of Pact, the
+    # database can not be rebuilt from anything else, so a file with a
+    # different version is an error.
+    version = 1
+
+    def __init__(self, path, native_arrays=True, compression=None):
+        self.path = path
+        self.native_arrays = native_arrays
+        self.compression = compression
+        # One connection per thread, as in Pact.
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        """ The SQLite connection of this thread, opened on first use. """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.open()
+            self._local.conn = conn
+        return conn
+
+    def open(self):
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        # See Pact.open_index for IMMEDIATE.
+        conn = sqlite3.connect(
+            self.path, timeout=60, isolation_level="IMMEDIATE"
+        )
+        conn.row_factory = sqlite3.Row
+        with conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version == 0:
+                self.create_tables(conn)
+            elif version != type(self).version:
+                msg = "{} has version {}, expected {}".format(
+                    self.path, version, type(self).version
+                )
+                raise ValueError(msg)
+        return conn
+
+    def create_tables(self, conn):
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " name TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " pars BLOB NOT NULL,"
+            " codec TEXT NOT NULL,"
+            " compression TEXT,"
+            " size INTEGER,"
+            " accessed REAL,"
+            " cost REAL,"
+            " data BLOB NOT NULL,"
+            " PRIMARY KEY (name, key))"
+        )
+        # As in the index of Pact.
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS pars ("
+            " name TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " par TEXT NOT NULL,"
+            " num REAL,"
+            " text TEXT,"
+            " PRIMARY KEY (name, key, par))"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS pars_num"
+            " ON pars (name, par, num, key)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS pars_text"
+            " ON pars (name, par, text, key)"
+        )
+        conn.execute("PRAGMA user_version = {:d}".format(type(self).version))
+        return
+
+    def lease_path(self, name, d):
+        key = self.generate_key(d)
+        return self.path + ".leases/" + name + "_" + key + ".lease"
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        return
+
+    def get_codec(self, data):
+        if self.native_arrays:
+            return pactcodecs.choose_codec(data)
+        else:
+            return "pickle"
+
+    def get_compression(self, name):
+        if isinstance(self.compression, dict):
+            return self.compression.get(name, None)
+        else:
+            return self.compression
+
+    def exists(self, name, d, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        row = self.conn.execute(
+            "SELECT 1 FROM entries WHERE name = ? AND key = ?",
+            (name, self.generate_key(d)),
+        ).fetchone()
+        return row is not None
+
+    def fetch(self, name, d, lazy=False, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        row = self.conn.execute(
+            "SELECT data FROM entries WHERE name = ? AND key = ?",
+            (name, self.generate_key(d)),
+        ).fetchone()
+        if row is None:
+            msg = "No entry in {} for {} {}".format(self.path, name, d)
+            raise FileNotFoundError(msg)
+        # A writable buffer, so that the arrays decoded from it are writable,
+        # as they are with Pact.
+        data = pactcodecs.loads(bytearray(row["data"]), lazy=lazy)
+        logging.info("Read {} from {}".format(name, self.path))
+        return data
+
+    def store(self, data, name, d, cost=None, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        self.store_many([(data, name, d)], cost=cost)
+        return
+
+    def store_many(self, items, cost=None):
+        # Serialize first, so that the write lock is held for as short a
+        # time as possible.
+        rows = []
+        for data, name, d in items:
+            codec = self.get_codec(data)
+            compression = self.get_compression(name)
+            f = io.BytesIO()
+            pactcodecs.dump(data, f, codec, compression)
+            buf = f.getvalue()
+            key = self.generate_key(d)
+            rows.append(
+                (
+                    name,
+                    key,
+                    pickle.dumps(d),
+                    codec,
+                    compression,
+                    len(buf),
+                    time.time(),
+                    cost,
+                    buf,
+                )
+            )
+        with self.conn as conn:
+            for row in rows:
+                name, key, d = row[0], row[1], pickle.loads(row[2])
+                conn.execute(
+                    "DELETE FROM pars WHERE name = ? AND key = ?", (name, key)
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries"
+                    " VALUES (?,?,?,?,?,?,?,?,?)",
+                    row,
+                )
+                conn.executemany(
+                    "INSERT INTO pars VALUES (?,?,?,?,?)",
+                    (
+                        (name, key, k) + self.par_to_columns(v)
+                        for k, v in d.items()
+                    ),
+                )
+        for row in rows:
+            logging.info("Wrote {} to {}".format(row[0], self.path))
+        return
+
+    def delete(self, name, d, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        args = (name, self.generate_key(d))
+        with self.conn as conn:
+            cursor = conn.execute(
+                "DELETE FROM entries WHERE name = ? AND key = ?", args
+            )
+            conn.execute("DELETE FROM pars WHERE name = ? AND key = ?", args)
+        return cursor.rowcount > 0
+
+    def query(self, name, **partial_pars):
+        sql = "SELECT pars FROM entries WHERE name = ?"
+        cond, args = self.pars_filter(name, partial_pars)
+        res = [
+            (pickle.loads(row["pars"]), None)
+            for row in self.conn.execute(sql + cond, [name] + args)
+        ]
+        return res
+
+    def backup(self, path):
+        """ Write a consistent copy of the whole database to path, even if
+        other processes are writing to it at the same time.
+        """
+        dest = sqlite3.connect(path)
+        try:
+            self.conn.backup(dest)
+        finally:
+            dest.close()
+        return
+
+
+class TieredPact(PactBackend):
+    """ A Pact in folder, with copies of recently fetched entries kept in
+    local_folder, which holds at most max_bytes of them. kwargs are passed to
+    Pact for folder.
+    """
+
+    def __init__(self, folder, local_folder, max_bytes, **kwargs):
+        self.shared = Pact(folder, **kwargs)
+        self.local_folder = local_folder
+        self.max_bytes = max_bytes
+        self.indexpath = local_folder + "tierindex.sqlite"
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        """ The connection of this thread to the index of the local copies,
+        opened on first use.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self.open()
+            self._local.conn = conn
+        return conn
+
+    def open(self):
+        os.makedirs(self.local_folder, exist_ok=True)
+        conn = sqlite3.connect(
+            self.indexpath, timeout=60, isolation_level="IMMEDIATE"
+        )
+        conn.row_factory = sqlite3.Row
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS copies ("
+                " name TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " filename TEXT NOT NULL,"
+                " token TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " accessed REAL NOT NULL,"
+                " length INTEGER NOT NULL,"
+                " PRIMARY KEY (name, key))"
+            )
+        return conn
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+        self.shared.close()
+        return
+
+    def exists(self, name, d, **kwargs):
+        return self.shared.exists(name, d, **kwargs)
+
+    def store(self, data, name, d, cost=None, **kwargs):
+        # A local copy of an older version is recognized as stale by its
+        # token when fetched, so there's no need to remove it here.
+        self.shared.store(data, name, d, cost=cost, **kwargs)
+        return
+
+    def store_many(self, items, **kwargs):
+        self.shared.store_many(items, **kwargs)
+        return
+
+    def delete(self, name, d, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        self.remove_copy(name, self.generate_key(d))
+        return self.shared.delete(name, d)
+
+    def query(self, name, **partial_pars):
+        return self.shared.query(name, **partial_pars)
+
+    def log_path(self, name, d):
+        return self.shared.log_path(name, d)
+
+    def lease_path(self, name, d):
+        return self.shared.lease_path(name, d)
+
+    def fetch(self, name, d, lazy=False, **kwargs):
+        d = self.update_dict(d, **kwargs)
+        row = self.shared.lookup(name, d)
+        if row is None:
+            path = self.shared.generate_path(name, d)
+            raise FileNotFoundError("No entry in index for {}".format(path))
+        self.shared.touch(row)
+        token = self.shared.entry_token(row)
+        local = self.conn.execute(
+            "SELECT * FROM copies WHERE name = ? AND key = ?",
+            (row["name"], row["key"]),
+        ).fetchone()
+        if local is not None and local["token"] == token:
+            try:
+                data = self.load_copy(
+                    row, local["filename"], local["length"], lazy=lazy
+                )
+            except FileNotFoundError:
+                # Removed by another process meanwhile.
+                pass
+            except CorruptEntryError as e:
+                msg = "{} Copying it again from {}."
+                logging.warning(msg.format(e, self.shared.folder))
+                self.remove_copy(row["name"], row["key"])
+            else:
+                with self.conn as conn:
+                    conn.execute(
+                        "UPDATE copies SET accessed = ?"
+                        " WHERE name = ? AND key = ?",
+                        (time.time(), row["name"], row["key"]),
+                    )
+                return data
+        if row["size"] is not None and row["size"] > self.max_bytes:
+            return self.shared.load_row(row, lazy=lazy)
+        filename, length = self.promote(row, token)
+        return self.load_copy(row, filename, length, lazy=lazy)
+
+    def load_copy(self, row, filename, length, lazy=False):
+        """ Load the local copy in filename of the entry with the shared
+        index row. Raises CorruptEntryError if the copy doesn't have length
+        bytes.
+        """
+        path = self.local_folder + filename
+        size = os.path.getsize(path)
+        if size != length:
+            msg = "The local copy {} has {} bytes, expected {}.".format(
+                path, size, length
+            )
+            raise CorruptEntryError(msg)
+        data = pactcodecs.load(
+            path, row["codec"], row["compression"], lazy=lazy
+        )
+        logging.info("Read from {}".format(path))
+        return data
+
+    def promote(self, row, token):
+        """ Copy the data of the entry with the shared index row to the
+        local folder, and return its filename there, and its length.
+        """
+        filename = row["filename"]
+        path = self.local_folder + filename
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with atomic_write(path, "wb") as f:
+            with open(self.shared.data_path(row), "rb") as src:
+                if row["segment"] is not None:
+                    src.seek(row["offset"])
+                    f.write(src.read(row["length"]))
+                else:
+                    shutil.copyfileobj(src, f, 2 ** 24)
+        size = os.path.getsize(path)
+        length = row["length"] if row["length"] is not None else size
+        with self.conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO copies VALUES (?,?,?,?,?,?,?)",
+                (
+                    row["name"],
+                    row["key"],
+                    filename,
+                    token,
+                    size,
+                    time.time(),
+                    length,
+                ),
+            )
+            self.evict(conn)
+        logging.info("Copied {} to {}".format(filename, self.local_folder))
+        return filename, length
+
+    def evict(self, conn):
+        """ Remove the least recently used local copies, until they fit in
+        max_bytes. Should be called within a transaction.
+        """
+        total = conn.execute("SELECT SUM(size) FROM copies").fetchone()[0]
+        if total is None or total <= self.max_bytes:
+            return
+        # The one just copied is the most recently used, and goes last.
+        for local in conn.execute(
+            "SELECT name, key, filename, size FROM copies" " ORDER BY accessed"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            self.remove_copy(local["name"], local["key"], conn=conn)
+            total -= local["size"]
+        return
+
+    def remove_copy(self, name, key, conn=None):
+        """ Remove the local copy of an entry, if there is one. """
+        with contextlib.ExitStack() as stack:
+            if conn is None:
+                conn = stack.enter_context(self.conn)
+            local = conn.execute(
+                "SELECT filename FROM copies WHERE name = ? AND key = ?",
+                (name, key),
+            ).fetchone()
+            if local is None:
+                return
+            conn.execute(
+                "DELETE FROM copies WHERE name = ? AND key = ?", (name, key)
+            )
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.local_folder + local["filename"])
+        return
@@ -0,0 +1,749 @@
+"""The formats in which Pact writes data to the disk.
+
+Every format, called a codec, is a pair of functions, one that writes data to
+an open binary file and one that reads it back given a path. The codecs are
+listed in the dictionary codecs, keyed by their names, and Pact records the
+name of the codec used for every entry in its index.
+
+The "pickle" codec is the general fallback, and works for any data that can be
+pickled.
+
+The "pickle5" codec is used instead of "pickle" where pickle protocol 5 is
+available, i.e. from Python 3.8 on. The data is pickled with NumPy arrays as
+out-of-band buffers, which are written after the pickle stream as raw bytes,
+aligned like in the "npy" codec. Arrays are thus written straight from their
+own memory, rather than copied into the pickle stream first, and when reading,
+the file is memory-mapped and the arrays are views into the map, without
+copying. This matters for data with arrays that the "npy" codec doesn't
+understand, such as arrays in the attributes of arbitrary objects.
+
+The "npy" codec is meant for NumPy arrays, abeliantensors tensors, and tuples,
+lists and dictionaries of them, such as the ((A,)*8, log_fact) returned by
+initialtensors_setup for "As". The file starts with a small JSON header that
+describes the structure of the data, for instance the shape, qhape, dirs and
+charge of an AbelianTensor, followed by the raw bytes of each array or sector,
+aligned to 64 bytes, as in a .npy file. When reading, the file is memory-mapped
+and the arrays are views into the map, so opening is almost free, only the
+parts of the data that are actually used are read from the disk, and the OS
+page cache is shared between processes reading the same file. The map is
+copy-on-write, so the arrays can be modified without affecting the file or
+other processes. Any parts of the data that aren't arrays or tensors, such as
+log_fact, are pickled within the file. Objects that appear several times in
+the data, like the eight copies of A above, are only written once.
+
+Data written with the npy codec can also be loaded lazily, in which case
+tuples, lists and dicts are returned as the proxies LazySequence and LazyDict,
+and the sectors of AbelianTensors are kept in a LazySects. These only build
+the elements that are actually accessed, and in particular never read from the
+disk the parts of the file that belong to other elements. For the pickle codec
+lazy loading is not possible, and the data is loaded in full.
+
+On top of either codec, the file can be compressed, with one of the methods
+in the dictionary compressions: "zlib", "lzma" or "shuffle-zlib". The last one
+splits the data into blocks, and reorders the bytes of every block so that
+the first bytes of all 8-byte elements come first, then the second bytes, and
+so on, before compressing the block with zlib. For float64 and complex128
+data, where the exponent bytes of neighbouring elements are often similar or
+zero, this usually compresses better and faster than zlib alone. A compressed
+file starts with a header that names the compression and the codec, so it can
+be loaded without knowing either. Compressed files can't be memory-mapped, so
+they are decompressed in full when loaded, even lazily.
+"""
+
+import collections.abc
+import copy
+import importlib
+import io
+import json
+import lzma
+import mmap
+import pickle
+import struct
+import zlib
+import numpy as np
+from abeliantensors import AbelianTensor
+
+npy_magic = b"PACTNPY\x01"
+npy_alignment = 64
+compressed_magic = b"PACTZIP\x01"
+pickle5_magic = b"PACTPK5\x01"
+# Protocol 5 and out-of-band buffers are new in Python 3.8.
+have_pickle5 = pickle.HIGHEST_PROTOCOL >= 5
+
+
+def choose_codec(data):
+    """ Return the name of the best codec for data. """
+    if contains_arrays(data):
+        return "npy"
+    elif have_pickle5:
+        return "pickle5"
+    else:
+        return "pickle"
+
+
+def contains_arrays(data):
+    if is_native_array(data) or isinstance(data, AbelianTensor):
+        return True
+    elif type(data) in (tuple, list):
+        return any(contains_arrays(x) for x in data)
+    elif type(data) is dict:
+        return any(contains_arrays(x) for x in data.values())
+    else:
+        return False
+
+
+def is_native_array(a):
+    """ Return whether a is a NumPy array that the npy codec can write as raw
+    bytes, i.e. one with a plain numerical dtype.
+    """
+    return (
+        isinstance(a, np.ndarray)
+        and not a.dtype.hasobject
+        and a.dtype.fields is None
+        and a.dtype.subdtype is None
+    )
+
+
+def detect_format(path):
+    """ Return the pair (codec, compression) of the names of the codec and
+    the compression that the file at path was written with. compression is
+    None for uncompressed files.
+    """
+    with open(path, "rb") as f:
+        start = f.read(len(npy_magic))
+        if start == compressed_magic:
+            size, header = read_compressed_header(f)
+            return header["codec"], header["compression"]
+    if start == npy_magic:
+        return "npy", None
+    elif start == pickle5_magic:
+        return "pickle5", None
+    else:
+        return "pickle", None
+
+
+def dump(data, f, codec, compression=None):
+    """ Write data to the binary file f, using the given codec and
+    compression. If compression is not None, f needs to be seekable.
+    """
+    if compression is None:
+        codecs[codec][0](data, f)
+    else:
+        dump_compressed(data, f, codec, compression)
+    return
+
+
+def load(path, codec=None, compression=None, lazy=False):
+    """ Load the data in the file at path. If codec is None, the codec and
+    the compression are detected from the file.
+    """
+    if codec is None:
+        codec, compression = detect_format(path)
+    if compression is None:
+        return codecs[codec][1](path, lazy=lazy)
+    else:
+        with open(path, "rb") as f:
+            buf, header = read_compressed(f)
+        return codecs[codec][2](buf, lazy=lazy)
+
+
+def loads(buf, lazy=False):
+    """ Like load, but reads the data from the bytes-like object buf,
+    detecting the codec and the compression.
+    """
+    start = bytes(buf[: len(npy_magic)])
+    if start == compressed_magic:
+        buf, header = read_compressed(io.BytesIO(buf))
+        codec = header["codec"]
+    elif start == npy_magic:
+        codec = "npy"
+    elif start == pickle5_magic:
+        codec = "pickle5"
+    else:
+        codec = "pickle"
+    return codecs[codec][2](buf, lazy=lazy)
+
+
+# # # The pickle codec
+
+
+def dump_pickle(data, f):
+    pickle.dump(data, f)
+    return
+
+
+def load_pickle(path, lazy=False):
+    with open(path, "rb") as f:
+        data = pickle.load(f)
+    return data
+
+
+def loads_pickle(buf, lazy=False):
+    return pickle.loads(buf)
+
+
+# # # The pickle5 codec
+#
+# The file starts with the magic bytes, the length of the pickle stream and
+# the number of buffers, and the lengths of the buffers, all as unsigned 64
+# bit integers. Then come the pickle stream, and the buffers, each one
+# starting at a multiple of npy_alignment.
+
+
+def dump_pickle5(data, f):
+    buffers = []
+    stream = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    buffers = [b.raw() for b in buffers]
+    f.write(pickle5_magic)
+    f.write(struct.pack("<QQ", len(stream), len(buffers)))
+    f.write(struct.pack("<{}Q".format(len(buffers)), *map(len, buffers)))
+    f.write(stream)
+    written = len(pickle5_magic) + 16 + 8 * len(buffers) + len(stream)
+    for buf in buffers:
+        f.write(bytes((-written) % npy_alignment))
+        written += (-written) % npy_alignment
+        f.write(buf)
+        written += len(buf)
+    return
+
+
+def loads_pickle5(buf, lazy=False):
+    """ Read data written by dump_pickle5 from buf, which can be any object
+    that supports the buffer protocol. The arrays returned are views into
+    buf.
+    """
+    buf = memoryview(buf).cast("B")
+    if bytes(buf[: len(pickle5_magic)]) != pickle5_magic:
+        raise ValueError("Not a file written by the pickle5 codec.")
+    pos = len(pickle5_magic)
+    stream_size, nbuffers = struct.unpack("<QQ", buf[pos : pos + 16])
+    pos += 16
+    sizes = struct.unpack(
+        "<{}Q".format(nbuffers), buf[pos : pos + 8 * nbuffers]
+    )
+    pos += 8 * nbuffers
+    stream = buf[pos : pos + stream_size]
+    pos += stream_size
+    buffers = []
+    for size in sizes:
+        pos += (-pos) % npy_alignment
+        buffers.append(buf[pos : pos + size])
+        pos += size
+    return pickle.loads(stream, buffers=buffers)
+
+
+def load_pickle5(path, lazy=False):
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return loads_pickle5(buf, lazy=lazy)
+
+
+# # # The npy codec
+
+
+def class_path(cls):
+    return "{}.{}".format(cls.__module__, cls.__qualname__)
+
+
+def path_class(path):
+    modulename, classname = path.rsplit(".", 1)
+    return getattr(importlib.import_module(modulename), classname)
+
+
+def to_json(x):
+    """ Convert the small pieces of data that go in the header, such as
+    qhapes and charges, into something JSON can handle.
+    """
+    if isinstance(x, (list, tuple)):
+        return [to_json(y) for y in x]
+    elif isinstance(x, np.generic):
+        return to_json(x.item())
+    elif isinstance(x, complex):
+        return {"complex": [x.real, x.imag]}
+    else:
+        return x
+
+
+def from_json(x):
+    if isinstance(x, list):
+        return [from_json(y) for y in x]
+    elif isinstance(x, dict) and "complex" in x:
+        return complex(*x["complex"])
+    else:
+        return x
+
+
+class NpyWriter:
+    """ Flattens data into a list of header nodes, and a list of buffers to
+    be written after the header. Every node is a dictionary, and nodes refer
+    to their children by their position in the list of nodes.
+    """
+
+    def __init__(self):
+        self.nodes = []
+        self.buffers = []
+        self.size = 0
+        # id(obj) -> (node number, obj), for objects that have already been
+        # added. obj is kept around, so that the id stays valid.
+        self.memo = {}
+
+    def add_buffer(self, buf):
+        offset = self.size
+        self.buffers.append((offset, buf))
+        size = len(buf)
+        self.size += size + (-size) % npy_alignment
+        return offset, size
+
+    def add(self, obj):
+        if id(obj) in self.memo:
+            return self.memo[id(obj)][0]
+        if is_native_array(obj):
+            node = self.array_node(obj)
+        elif isinstance(obj, AbelianTensor):
+            node = self.abelian_node(obj)
+        elif type(obj) in (tuple, list) and contains_arrays(obj):
+            node = {
+                "kind": type(obj).__name__,
+                "items": [self.add(x) for x in obj],
+            }
+        elif type(obj) is dict and contains_arrays(obj):
+            node = {
+                "kind": "dict",
+                "items": [[self.add(k), self.add(v)] for k, v in obj.items()],
+            }
+        else:
+            offset, size = self.add_buffer(pickle.dumps(obj))
+            node = {"kind": "pickle", "offset": offset, "size": size}
+        self.nodes.append(node)
+        i = len(self.nodes) - 1
+        self.memo[id(obj)] = (i, obj)
+        return i
+
+    def array_node(self, a):
+        if a.flags.f_contiguous and not a.flags.c_contiguous:
+            order = "F"
+            raw = a.T
+        else:
+            order = "C"
+            raw = np.ascontiguousarray(a)
+        raw = np.asarray(raw).reshape(-1).view(np.uint8)
+        offset, size = self.add_buffer(raw)
+        node = {
+            "kind": "ndarray",
+            "class": class_path(type(a)),
+            "dtype": a.dtype.str,
+            "shape": list(a.shape),
+            "order": order,
+            "offset": offset,
+            "size": size,
+        }
+        return node
+
+    def abelian_node(self, T):
+        sects = [[to_json(k), self.add(v)] for k, v in T.sects.items()]
+        node = {
+            "kind": "abelian",
+            "class": class_path(type(T)),
+            "shape": to_json(T.shape),
+            "qhape": to_json(T.qhape),
+            "qodulus": to_json(T.qodulus),
+            "dirs": to_json(T.dirs),
+            "charge": to_json(T.charge),
+            "defval": to_json(T.defval),
+            "invar": T.invar,
+            "dtype": np.dtype(T.dtype).str,
+            "sects": sects,
+        }
+        return node
+
+
+def dump_npy(data, f):
+    writer = NpyWriter()
+    root = writer.add(data)
+    header = {"root": root, "nodes": writer.nodes}
+    header = json.dumps(header, separators=(",", ":")).encode("UTF-8")
+    f.write(npy_magic)
+    f.write(struct.pack("<Q", len(header)))
+    f.write(header)
+    written = len(npy_magic) + 8 + len(header)
+    f.write(bytes((-written) % npy_alignment))
+    for offset, buf in writer.buffers:
+        f.write(buf)
+        f.write(bytes((-len(buf)) % npy_alignment))
+    return
+
+
+class NpyReader:
+    """ Rebuilds data from the header nodes written by NpyWriter, with arrays
+    that are views into buf. Nodes are only built when asked for. If lazy is
+    True, containers and the sectors of tensors are built as lazy proxies.
+    """
+
+    def __init__(self, buf, header, start, lazy=False):
+        self.buf = buf
+        self.nodes = header["nodes"]
+        self.root = header["root"]
+        self.start = start
+        self.lazy = lazy
+        self.memo = {}
+
+    def get(self, i):
+        if i not in self.memo:
+            self.memo[i] = self.build(self.nodes[i])
+        return self.memo[i]
+
+    def build(self, node):
+        kind = node["kind"]
+        if kind == "ndarray":
+            return self.build_array(node)
+        elif kind == "abelian":
+            return self.build_abelian(node)
+        elif kind in ("tuple", "list") and self.lazy:
+            return LazySequence(self, node["items"], kind)
+        elif kind == "tuple":
+            return tuple(self.get(i) for i in node["items"])
+        elif kind == "list":
+            return [self.get(i) for i in node["items"]]
+        elif kind == "dict" and self.lazy:
+            return LazyDict(self, node["items"])
+        elif kind == "dict":
+            return {self.get(k): self.get(v) for k, v in node["items"]}
+        elif kind == "pickle":
+            start = self.start + node["offset"]
+            return pickle.loads(self.buf[start : start + node["size"]])
+        else:
+            raise ValueError("Unknown node kind in npy file: {}".format(kind))
+
+    def build_array(self, node):
+        dtype = np.dtype(node["dtype"])
+        shape = node["shape"]
+        if node["size"] == 0:
+            a = np.empty(shape, dtype=dtype)
+        else:
+            a = np.frombuffer(
+                self.buf,
+                dtype=dtype,
+                count=node["size"] // dtype.itemsize,
+                offset=self.start + node["offset"],
+            )
+            a = a.reshape(shape, order=node["order"])
+        cls = path_class(node["class"])
+        if cls is not np.ndarray:
+            a = a.view(cls)
+        return a
+
+    def build_abelian(self, node):
+        cls = path_class(node["class"])
+        if self.lazy:
+            sects = LazySects(self, {tuple(k): i for k, i in node["sects"]})
+        else:
+            sects = {tuple(k): self.get(i) for k, i in node["sects"]}
+        T = cls(
+            from_json(node["shape"]),
+            qhape=from_json(node["qhape"]),
+            qodulus=node["qodulus"],
+            sects=sects,
+            dirs=node["dirs"],
+            dtype=np.dtype(node["dtype"]),
+            defval=from_json(node["defval"]),
+            charge=from_json(node["charge"]),
+            invar=node["invar"],
+        )
+        return T
+
+
+class LazySequence(collections.abc.Sequence):
+    """ A read-only proxy for a tuple or a list loaded lazily by NpyReader.
+    Supports indexing, slicing, len and iteration (and thus unpacking), and
+    only builds the elements that are accessed. load returns the actual
+    tuple or list.
+    """
+
+    def __init__(self, reader, items, kind):
+        self.reader = reader
+        self.items = items
+        self.kind = kind
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.reader.get(j) for j in self.items[i]]
+        return self.reader.get(self.items[i])
+
+    def __len__(self):
+        return len(self.items)
+
+    def __repr__(self):
+        return "LazySequence({}, length {})".format(self.kind, len(self))
+
+    def load(self):
+        res = [self[i] for i in range(len(self))]
+        if self.kind == "tuple":
+            res = tuple(res)
+        return res
+
+
+class LazyDict(collections.abc.Mapping):
+    """ A read-only proxy for a dict loaded lazily by NpyReader. The keys
+    are built right away, the values only when accessed. load returns the
+    actual dict.
+    """
+
+    def __init__(self, reader, items):
+        self.reader = reader
+        self.items_ = {reader.get(k): v for k, v in items}
+
+    def __getitem__(self, k):
+        return self.reader.get(self.items_[k])
+
+    def __iter__(self):
+        return iter(self.items_)
+
+    def __len__(self):
+        return len(self.items_)
+
+    def __repr__(self):
+        return "LazyDict(keys {})".format(list(self.items_))
+
+    def load(self):
+        return dict(self.items())
+
+
+class LazySects(collections.abc.MutableMapping):
+    """ The sectors of an AbelianTensor loaded lazily by NpyReader. Behaves
+    like the usual dict of sectors, but every sector is only built when it is
+    first accessed. Copies and pickles are plain dicts.
+    """
+
+    def __init__(self, reader, sects):
+        self.reader = reader
+        # Values are either sectors, or node numbers wrapped in a tuple for
+        # sectors that haven't been built yet.
+        self.sects = {k: (i,) for k, i in sects.items()}
+
+    def __getitem__(self, k):
+        v = self.sects[k]
+        if type(v) is tuple:
+            v = self.reader.get(v[0])
+            self.sects[k] = v
+        return v
+
+    def __setitem__(self, k, v):
+        self.sects[k] = v
+
+    def __delitem__(self, k):
+        del self.sects[k]
+
+    def __iter__(self):
+        return iter(self.sects)
+
+    def __len__(self):
+        return len(self.sects)
+
+    def __contains__(self, k):
+        return k in self.sects
+
+    def __repr__(self):
+        return "LazySects({})".format(list(self.sects))
+
+    def copy(self):
+        res = type(self)(self.reader, {})
+        res.sects = self.sects.copy()
+        return res
+
+    def __deepcopy__(self, memo):
+        return {k: copy.deepcopy(v, memo) for k, v in self.items()}
+
+    def __reduce__(self):
+        return (dict, (dict(self.items()),))
+
+
+def read_npy_header(buf):
+    if bytes(buf[: len(npy_magic)]) != npy_magic:
+        raise ValueError("Not a file written by the npy codec.")
+    pos = len(npy_magic)
+    (header_size,) = struct.unpack("<Q", buf[pos : pos + 8])
+    pos += 8
+    header = json.loads(bytes(buf[pos : pos + header_size]).decode("UTF-8"))
+    pos += header_size
+    start = pos + (-pos) % npy_alignment
+    return header, start
+
+
+def loads_npy(buf, lazy=False):
+    """ Read data written by dump_npy from buf, which can be any object that
+    supports the buffer protocol. The arrays returned are views into buf.
+    """
+    header, start = read_npy_header(buf)
+    reader = NpyReader(buf, header, start, lazy=lazy)
+    return reader.get(reader.root)
+
+
+def load_npy(path, lazy=False):
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    return loads_npy(buf, lazy=lazy)
+
+
+# # # Compression
+
+
+def shuffle(b, typesize=8):
+    """ Reorder the bytes in b so that the first bytes of all elements of
+    size typesize come first, then all the second bytes, etc. Any bytes at
+    the end that don't make up a full element are left as they are.
+    """
+    n = len(b) - len(b) % typesize
+    a = np.frombuffer(b, dtype=np.uint8, count=n).reshape(-1, typesize)
+    return a.T.tobytes() + bytes(b[n:])
+
+
+def unshuffle(b, typesize=8):
+    """ The inverse of shuffle. """
+    n = len(b) - len(b) % typesize
+    a = np.frombuffer(b, dtype=np.uint8, count=n).reshape(typesize, -1)
+    return a.T.tobytes() + bytes(b[n:])
+
+
+class ShuffleCompressor:
+    """ A compressor for the shuffle-zlib compression, with the same
+    interface as zlib.compressobj. The data is cut into blocks, each block
+    is shuffled and compressed, and written out prefixed by its uncompressed
+    and compressed lengths.
+    """
+
+    blocksize = 2 ** 20
+
+    def __init__(self):
+        self.pending = bytearray()
+
+    def compress_block(self, block):
+        zblock = zlib.compress(shuffle(block))
+        return struct.pack("<II", len(block), len(zblock)) + zblock
+
+    def compress(self, b):
+        self.pending += memoryview(b).cast("B")
+        out = []
+        n = self.blocksize
+        while len(self.pending) >= n:
+            out.append(self.compress_block(bytes(self.pending[:n])))
+            del self.pending[:n]
+        return b"".join(out)
+
+    def flush(self):
+        out = b""
+        if self.pending:
+            out = self.compress_block(bytes(self.pending))
+            self.pending = bytearray()
+        return out
+
+
+class ShuffleDecompressor:
+    """ A decompressor for the shuffle-zlib compression, with the same
+    interface as zlib.decompressobj.
+    """
+
+    def __init__(self):
+        self.pending = bytearray()
+
+    def decompress(self, b):
+        self.pending += memoryview(b).cast("B")
+        out = []
+        while len(self.pending) >= 8:
+            size, zsize = struct.unpack("<II", self.pending[:8])
+            if len(self.pending) < 8 + zsize:
+                break
+            block = zlib.decompress(bytes(self.pending[8 : 8 + zsize]))
+            out.append(unshuffle(block))
+            del self.pending[: 8 + zsize]
+        return b"".join(out)
+
+
+# For each compression, functions that return a new compressor and a new
+# decompressor object.
+compressions = {
+    "zlib": (zlib.compressobj, zlib.decompressobj),
+    "lzma": (lzma.LZMACompressor, lzma.LZMADecompressor),
+    "shuffle-zlib": (ShuffleCompressor, ShuffleDecompressor),
+}
+
+
+class CompressingWriter:
+    """ A minimal write-only file object, that compresses everything written
+    to it before writing it to f.
+    """
+
+    def __init__(self, f, compression):
+        self.f = f
+        self.compressor = compressions[compression][0]()
+        self.size = 0
+
+    def write(self, b):
+        self.f.write(self.compressor.compress(b))
+        size = memoryview(b).nbytes
+        self.size += size
+        return size
+
+    def finish(self):
+        self.f.write(self.compressor.flush())
+        return
+
+
+def dump_compressed(data, f, codec, compression):
+    # The header has the length of the uncompressed data, so that it can be
+    # decompressed into a buffer of the right size. We only know it once
+    # everything has been written, so we come back to write it in the end.
+    header = json.dumps({"codec": codec, "compression": compression})
+    header = header.encode("UTF-8")
+    f.write(compressed_magic)
+    sizepos = f.tell()
+    f.write(struct.pack("<QI", 0, len(header)))
+    f.write(header)
+    writer = CompressingWriter(f, compression)
+    codecs[codec][0](data, writer)
+    writer.finish()
+    endpos = f.tell()
+    f.seek(sizepos)
+    f.write(struct.pack("<Q", writer.size))
+    f.seek(endpos)
+    return
+
+
+def read_compressed_header(f):
+    """ Read the header of a compressed file from f, that is positioned
+    right after the magic bytes. Return the size of the uncompressed data
+    and the header dictionary.
+    """
+    size, header_size = struct.unpack("<QI", f.read(12))
+    header = json.loads(f.read(header_size).decode("UTF-8"))
+    return size, header
+
+
+def read_compressed(f, chunksize=2 ** 24):
+    """ Read and decompress the compressed file f. Return the uncompressed
+    data as a bytearray, and the header dictionary.
+    """
+    f.read(len(compressed_magic))
+    size, header = read_compressed_header(f)
+    decompressor = compressions[header["compression"]][1]()
+    buf = bytearray(size)
+    pos = 0
+    while True:
+        chunk = f.read(chunksize)
+        if not chunk:
+            break
+        out = decompressor.decompress(chunk)
+        buf[pos : pos + len(out)] = out
+        pos += len(out)
+    if pos != size:
+        msg = "Compressed data decompressed to {} bytes, expected {}."
+        raise ValueError(msg.format(pos, size))
+    return buf, header
+
+
+# For each codec, functions for writing data to a file, reading data from a
+# path, and reading data from a bytes-like object.
+codecs = {
+    "pickle": (dump_pickle, load_pickle, loads_pickle),
+    "npy": (dump_npy, load_npy, loads_npy),
+    "pickle5": (dump_pickle5, load_pickle5, loads_pickle5),
+}
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# Run the tests against the source tree, without installing it.
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+)
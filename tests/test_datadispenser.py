@@ -0,0 +1,219 @@
+import concurrent.futures
+import os
+
+import numpy as np
+import pytest
+
+from tntools import datadispenser
+from tntools.pact import Pact
+from tntools.pactbackends import MemoryPact
+
+
+def folder_of(path):
+    return str(path) + "/"
+
+
+def toy_pars(record, **kwargs):
+    pars = {"algorithm": "toy", "x": 1.0}
+    if record is not None:
+        pars["record"] = str(record)
+    pars.update(kwargs)
+    return pars
+
+
+def generated(record):
+    """ Return the sorted list of (dataname, iter_count) generated. """
+    res = []
+    for filename in os.listdir(str(record)):
+        dataname, iter_count = filename.split("_")[:2]
+        res.append((dataname, int(iter_count)))
+    return sorted(res)
+
+
+def stored_iterations(db, **pars):
+    return sorted(d["iter_count"] for d, path in Pact(db).query("T", **pars))
+
+
+@pytest.fixture
+def record(tmp_path):
+    record = tmp_path / "record"
+    record.mkdir()
+    return record
+
+
+def test_get_data_chain(tmp_path, record):
+    db = folder_of(tmp_path / "db")
+    pars = toy_pars(record, iter_count=5)
+    data = datadispenser.get_data(db, "T", pars)
+    np.testing.assert_array_equal(data, np.full(3, 32.0))
+    assert generated(record) == [("T", i) for i in range(6)]
+    assert stored_iterations(db) == list(range(6))
+    datadispenser.get_data(db, "T", pars)
+    assert len(generated(record)) == 6
+
+
+def test_update_default_pars_and_get_idpars():
+    pars = {"algorithm": "toy", "iter_count": 2}
+    assert datadispenser.update_default_pars("S", pars) is pars
+    expected = toy_pars(None, iter_count=2, x=2.0, sleep=0.0)
+    expected["record"] = None
+    assert pars == expected
+    plan = datadispenser.make_plan(None, "S", pars)
+    idpars = datadispenser.get_idpars("S", pars)
+    assert idpars == plan.idpars == {"iter_count": 2, "x": 2.0}
+
+
+def test_deep_chain_without_recursion(tmp_path):
+    db = folder_of(tmp_path / "db")
+    pars = toy_pars(None, iter_count=1500, x=1e-300)
+    datadispenser.get_data(db, "T", pars)
+    assert stored_iterations(db) == list(range(1501))
+
+
+@pytest.mark.parametrize("kind", ["pact", "memory"])
+def test_parallel_generation(tmp_path, record, kind):
+    # A Pact is generated into by processes, a MemoryPact by threads.
+    if kind == "pact":
+        db = folder_of(tmp_path / "db")
+    else:
+        db = MemoryPact()
+    pars = toy_pars(record, iter_count=3)
+    data = datadispenser.get_data(db, "S", pars, max_workers=3)
+    np.testing.assert_array_equal(data, np.full(3, 3 * 8.0))
+    # Every node of the DAG was generated once.
+    expected = sorted(
+        ["S_3_1.0"]
+        + ["T_{}_{}".format(i, x) for i in range(4) for x in [1.0, 2.0]]
+    )
+    nodes = sorted(f.rsplit("_", 1)[0] for f in os.listdir(str(record)))
+    assert nodes == expected
+    datadispenser.get_data(db, "S", pars, max_workers=3)
+    assert len(os.listdir(str(record))) == len(expected)
+
+
+@pytest.mark.parametrize(
+    "policy, expected",
+    [
+        (datadispenser.keep_every(10), [0, 10, 20, 30, 40]),
+        (datadispenser.keep_ladder(2), [1, 2, 4, 8, 16, 32]),
+        (datadispenser.keep_last(3), [43, 44, 45]),
+    ],
+)
+def test_storage_policy(tmp_path, record, monkeypatch, policy, expected):
+    db = folder_of(tmp_path / "db")
+    monkeypatch.setitem(datadispenser.storage_policies, "T", policy)
+    data = datadispenser.get_data(db, "T", toy_pars(record, iter_count=45))
+    np.testing.assert_array_equal(data, np.full(3, 2.0 ** 45))
+    assert stored_iterations(db) == expected
+
+
+def test_storage_policy_fills_gaps(tmp_path, record, monkeypatch):
+    db = folder_of(tmp_path / "db")
+    monkeypatch.setitem(
+        datadispenser.storage_policies, "T", datadispenser.keep_every(10)
+    )
+    datadispenser.get_data(db, "T", toy_pars(record, iter_count=45))
+    for filename in os.listdir(str(record)):
+        os.remove(os.path.join(str(record), filename))
+    data = datadispenser.get_data(db, "T", toy_pars(record, iter_count=37))
+    np.testing.assert_array_equal(data, np.full(3, 2.0 ** 37))
+    # Run forward from the checkpoint at 30.
+    assert generated(record) == [("T", i) for i in range(31, 38)]
+
+
+def test_keep_last_prunes_earlier_iterations(tmp_path, record, monkeypatch):
+    db = folder_of(tmp_path / "db")
+    monkeypatch.setitem(
+        datadispenser.storage_policies, "T", datadispenser.keep_last(3)
+    )
+    datadispenser.get_data(db, "T", toy_pars(record, iter_count=20))
+    assert stored_iterations(db) == [18, 19, 20]
+    datadispenser.get_data(db, "T", toy_pars(record, iter_count=30))
+    assert stored_iterations(db) == [28, 29, 30]
+    # Only the iterations after the last checkpoint were generated again.
+    assert len(generated(record)) == 21 + 10
+
+
+def test_keep_last_leaves_other_chains_alone(tmp_path, record, monkeypatch):
+    db = folder_of(tmp_path / "db")
+    monkeypatch.setitem(
+        datadispenser.storage_policies, "T", datadispenser.keep_last(1)
+    )
+    p = Pact(db)
+    pars = toy_pars(record, iter_count=5)
+    idpars = datadispenser.make_plan(p, "T", pars).idpars
+    # A chain with an extra idpar, that a partial query of the other one
+    # also matches.
+    for i in range(6):
+        p.store(i, "T", dict(idpars, iter_count=i, other="keepme"))
+    datadispenser.get_data(db, "T", pars)
+    assert stored_iterations(db) == list(range(6)) + [5]
+    assert stored_iterations(db, other="keepme") == list(range(6))
+
+
+@pytest.mark.parametrize(
+    "factory, arg",
+    [
+        (datadispenser.keep_every, 0),
+        (datadispenser.keep_ladder, 1),
+        (datadispenser.keep_last, 0),
+    ],
+)
+def test_storage_policy_arguments(factory, arg):
+    with pytest.raises(ValueError):
+        factory(arg)
+
+
+def get_data_job(db, pars):
+    return datadispenser.get_data(db, "S", pars)
+
+
+def test_leases_deduplicate_across_processes(tmp_path, record, monkeypatch):
+    db = folder_of(tmp_path / "db")
+    monkeypatch.setattr(datadispenser, "lease_poll_interval", 0.02)
+    pars = toy_pars(record, iter_count=3, sleep=0.2)
+    with concurrent.futures.ProcessPoolExecutor(4) as executor:
+        futures = [executor.submit(get_data_job, db, pars) for _ in range(4)]
+        results = [future.result() for future in futures]
+    for data in results:
+        np.testing.assert_array_equal(data, np.full(3, 3 * 8.0))
+    # Every piece of data was generated once, by one of the processes.
+    expected = sorted([("S", 3)] + [("T", i) for i in range(4)] * 2)
+    assert generated(record) == expected
+    leases = os.listdir(db + "leases")
+    assert not [f for f in leases if f.endswith(".lease")]
+
+
+def test_stale_lease_is_taken_over(tmp_path, record):
+    db = folder_of(tmp_path / "db")
+    pars = toy_pars(record, iter_count=0)
+    p = Pact(db)
+    plan = datadispenser.make_plan(p, "T", pars)
+    path = p.lease_path("T", plan.idpars)
+    os.makedirs(os.path.dirname(path))
+    open(path, "w").close()
+    old = os.path.getmtime(path) - 2 * datadispenser.lease_timeout
+    os.utime(path, (old, old))
+    datadispenser.get_data(db, "T", pars)
+    assert generated(record) == [("T", 0)]
+    assert not os.path.exists(path)
+
+
+class FailingPact(MemoryPact):
+    def store(self, data, name, d, **kwargs):
+        raise OSError("Disk full")
+
+
+def test_wait_for_writes_raises_errors_of_storing(record):
+    datadispenser.enable_write_behind()
+    try:
+        db = FailingPact()
+        data = datadispenser.get_data(db, "T", toy_pars(record, iter_count=2))
+        np.testing.assert_array_equal(data, np.full(3, 4.0))
+        with pytest.raises(OSError, match="Disk full"):
+            datadispenser.wait_for_writes()
+        # The error is only raised once.
+        datadispenser.wait_for_writes()
+        assert not db.query("T")
+    finally:
+        datadispenser.disable_write_behind()
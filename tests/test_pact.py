@@ -0,0 +1,362 @@
+import concurrent.futures
+import os
+import pickle
+import time
+
+import numpy as np
+import pytest
+import yaml
+from abeliantensors import TensorU1, TensorZ2
+
+from tntools import pact
+from tntools.pact import FetchCache, Pact
+
+
+def folder_of(tmp_path):
+    return str(tmp_path) + "/"
+
+
+def test_reconstruct_index_after_quarantine(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder)
+    p.store(np.arange(1000.0), "a", {"x": 1})
+    p.store(np.arange(10.0), "b", {"x": 2})
+    path = p.generate_path("a", {"x": 1})
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    report = p.verify_all()
+    assert len(report["corrupt"]) == 1
+    p.reconstruct_index()
+    assert not p.exists("a", {"x": 1})
+    assert p.exists("b", {"x": 2})
+    qfiles = os.listdir(folder + "quarantine")
+    assert sorted(os.path.splitext(f)[1] for f in qfiles) == [".p", ".yaml"]
+    # The quarantined files are left alone by a second verify.
+    p.verify_all()
+    assert sorted(os.listdir(folder + "quarantine")) == sorted(qfiles)
+
+
+def store_range(folder, start, stop, pack_threshold):
+    p = Pact(folder, pack_threshold=pack_threshold)
+    for i in range(start, stop):
+        p.store(np.full(10, float(i)), "a", {"i": i})
+        # Everyone also stores the same entries.
+        p.store(np.arange(5.0), "shared", {"j": i % 3})
+    return
+
+
+@pytest.mark.parametrize("pack_threshold", [None, 10 ** 6])
+def test_concurrent_store(tmp_path, pack_threshold):
+    folder = folder_of(tmp_path)
+    n, per_process = 4, 25
+    with concurrent.futures.ProcessPoolExecutor(n) as executor:
+        futures = [
+            executor.submit(
+                store_range,
+                folder,
+                k * per_process,
+                (k + 1) * per_process,
+                pack_threshold,
+            )
+            for k in range(n)
+        ]
+        for future in futures:
+            future.result()
+    p = Pact(folder)
+    assert len(p.query("a")) == n * per_process
+    assert len(p.query("shared")) == 3
+    for i in range(n * per_process):
+        np.testing.assert_array_equal(
+            p.fetch("a", {"i": i}), np.full(10, float(i))
+        )
+    assert not p.verify_all()["corrupt"]
+
+
+def test_reconstruct_index(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder)
+    p.store(np.arange(3.0), "a", {"i": 0, "tag": "t"})
+    p.store("text", "b", {"i": 1})
+    os.remove(folder + "pactindex.sqlite")
+    p = Pact(folder)
+    p.reconstruct_index()
+    np.testing.assert_array_equal(
+        p.fetch("a", {"i": 0, "tag": "t"}), np.arange(3.0)
+    )
+    assert p.fetch("b", {"i": 1}) == "text"
+    assert len(p.query("a", tag="t")) == 1
+
+
+def test_reconstruct_index_with_blobs(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder, dedup=True)
+    big = np.arange(10000.0)
+    p.store(big, "blob", {"i": 0})
+    p.store(big, "blob", {"i": 1})
+    assert os.listdir(folder + "blobs")
+    p = Pact(folder)
+    p.reconstruct_index()
+    for i in range(2):
+        np.testing.assert_array_equal(p.fetch("blob", {"i": i}), big)
+    assert not p.verify_all()["corrupt"]
+
+
+def test_fetch_legacy_hash(tmp_path):
+    folder = folder_of(tmp_path)
+    os.makedirs(folder, exist_ok=True)
+    p = Pact(folder)
+    d = {"beta": 1, "dtype": np.float64, "chis": (1, 2)}
+    # The files as an older version of Pact would have written them.
+    stem = folder + "A_" + p.generate_key(d, legacy=True)
+    assert stem != folder + "A_" + p.generate_key(d)
+    with open(stem + ".p", "wb") as f:
+        pickle.dump("old", f)
+    with open(stem + ".yaml", "w") as f:
+        yaml.dump(d, f)
+    p = Pact(folder)
+    assert p.exists("A", d)
+    assert p.fetch("A", d) == "old"
+
+
+def test_reconstruct_index_with_segments(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder, pack_threshold=10 ** 6)
+    for i in range(4):
+        p.store(np.full(4, float(i)), "packed", {"i": i})
+    # A tombstone for a deleted entry, and a newer record for another.
+    p.delete("packed", {"i": 1})
+    p.store(np.full(4, 10.0), "packed", {"i": 2})
+    assert os.listdir(folder + "segments")
+    p = Pact(folder)
+    p.reconstruct_index()
+    assert not p.exists("packed", {"i": 1})
+    expected = {0: 0.0, 2: 10.0, 3: 3.0}
+    for i, v in expected.items():
+        np.testing.assert_array_equal(
+            p.fetch("packed", {"i": i}), np.full(4, v)
+        )
+    assert len(p.query("packed")) == 3
+    assert not p.verify_all()["corrupt"]
+
+
+def test_sync_copies_logs_of_packed_entries(tmp_path):
+    src = Pact(folder_of(tmp_path / "src"), pack_threshold=10 ** 6)
+    src.store(np.arange(10.0), "a", {"x": 1})
+    logpath = src.log_path("a", {"x": 1})
+    os.makedirs(os.path.dirname(logpath), exist_ok=True)
+    with open(logpath, "w") as f:
+        f.write("log\n")
+    src.sync(folder_of(tmp_path / "dest"))
+    dest = Pact(folder_of(tmp_path / "dest"))
+    np.testing.assert_array_equal(dest.fetch("a", {"x": 1}), np.arange(10.0))
+    with open(dest.log_path("a", {"x": 1})) as f:
+        assert f.read() == "log\n"
+
+
+def test_canonical_string_of_classes():
+    canonical_string = Pact.canonical_string
+    assert canonical_string({"cls": TensorZ2}) != canonical_string(
+        {"cls": TensorU1}
+    )
+    assert canonical_string({"dtype": np.float64}) == canonical_string(
+        {"dtype": float}
+    )
+    assert canonical_string({"dtype": np.object_}) == canonical_string(
+        {"dtype": np.dtype(object)}
+    )
+
+
+def test_file_modes(tmp_path):
+    folder = folder_of(tmp_path / "src")
+    p = Pact(folder)
+    p.store(np.arange(3.0), "a", {"i": 0})
+    Pact(folder, dedup=True).store(np.arange(3.0), "b", {"i": 0})
+    p.sync(folder_of(tmp_path / "dest"))
+    for root, dirs, files in os.walk(str(tmp_path)):
+        for filename in files:
+            if filename.endswith((".p", ".yaml")) or "blobs" in root:
+                mode = os.stat(os.path.join(root, filename)).st_mode
+                assert mode & 0o777 == pact.file_mode
+
+
+def test_query_paths(tmp_path):
+    folder = folder_of(tmp_path)
+    Pact(folder).store(np.arange(1000.0), "a", {"i": 0})
+    Pact(folder, pack_threshold=10 ** 6).store(np.arange(3.0), "a", {"i": 1})
+    paths = {d["i"]: path for d, path in Pact(folder).query("a")}
+    assert os.path.exists(paths[0])
+    assert paths[1] is None
+
+
+def segments_size(folder):
+    segmentfolder = folder + "segments/"
+    return sum(
+        os.path.getsize(segmentfolder + f) for f in os.listdir(segmentfolder)
+    )
+
+
+def test_gc_compacts_segments(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder, pack_threshold=10 ** 6)
+    for i in range(10):
+        p.store(np.full(100, float(i)), "a", {"i": i}, cost=float(i))
+    size = sum(
+        row["size"] for row in p.index.execute("SELECT size FROM entries")
+    )
+    before = segments_size(folder)
+    report = p.gc(size // 2)
+    assert len(report) == 5
+    freed = before - segments_size(folder)
+    assert freed >= sum(r["size"] for r in report)
+    for d, path in p.query("a"):
+        np.testing.assert_array_equal(
+            p.fetch("a", d), np.full(100, float(d["i"]))
+        )
+    assert len(p.query("a")) == 5
+
+
+def test_gc_counts_shared_blobs_once(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder, dedup=True)
+    big = np.arange(10000.0)
+    for i in range(3):
+        p.store(big, "a", {"i": i})
+    blob_size = big.nbytes
+    # The three entries take little more space than one blob.
+    assert not p.gc(2 * blob_size)
+    report = p.gc(0)
+    assert len(report) == 3
+    sizes = [r["size"] for r in report]
+    assert sizes[2] > blob_size > sizes[0] + sizes[1]
+    assert not os.path.exists(folder + "blobs")
+
+
+def test_gc_order_and_dry_run(tmp_path):
+    p = Pact(folder_of(tmp_path))
+    costs = [10.0, 1.0, 100.0]
+    for i, cost in enumerate(costs):
+        p.store(np.zeros(1000), "a", {"i": i}, cost=cost)
+    sizes = [
+        row["size"] for row in p.index.execute("SELECT size FROM entries")
+    ]
+    filenames = [p.generate_filename("a", {"i": i}) for i in range(3)]
+    report = p.gc(sum(sizes) - 1, dry_run=True)
+    assert [r["filename"] for r in report] == [filenames[1]]
+    assert all(p.exists("a", {"i": i}) for i in range(3))
+    # The cheapest entries to generate again go first.
+    report = p.gc(max(sizes))
+    assert [r["filename"] for r in report] == [filenames[1], filenames[0]]
+    assert [p.exists("a", {"i": i}) for i in range(3)] == [False, False, True]
+    assert not os.path.exists(p.generate_path("a", {"i": 1}))
+
+
+def test_fetch_after_migrate_layout(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder)
+    for i in range(5):
+        p.store(np.full(3, float(i)), "a", {"i": i})
+    # Another user of the folder, that knows the old layout.
+    other = Pact(folder)
+    assert other.layout == "flat"
+    p.migrate_layout("sharded")
+    assert p.generate_filename("a", {"i": 0}).count(os.sep) == 2
+    assert os.path.exists(p.generate_path("a", {"i": 0}))
+    for q in [p, other, Pact(folder)]:
+        for i in range(5):
+            np.testing.assert_array_equal(
+                q.fetch("a", {"i": i}), np.full(3, float(i))
+            )
+    p.migrate_layout("flat")
+    for i in range(5):
+        np.testing.assert_array_equal(
+            Pact(folder).fetch("a", {"i": i}), np.full(3, float(i))
+        )
+    assert not [f for f in os.listdir(folder) if len(f) == 2]
+
+
+def test_fetch_many_streams_in_completion_order(tmp_path, monkeypatch):
+    p = Pact(folder_of(tmp_path))
+    p.store_many((np.full(3, float(i)), "a", {"i": i}) for i in range(4))
+    load_row = p.load_row
+
+    def slow_load_row(row, lazy=False):
+        if pickle.loads(row["pars"])["i"] == 0:
+            time.sleep(0.5)
+        return load_row(row, lazy=lazy)
+
+    monkeypatch.setattr(p, "load_row", slow_load_row)
+    pairs = [("a", {"i": i}) for i in range(4)]
+    with pytest.raises(FileNotFoundError):
+        p.fetch_many(pairs + [("a", {"i": 4})])
+    fetched = list(p.fetch_many(pairs))
+    assert sorted(d["i"] for name, d, data in fetched) == list(range(4))
+    for name, d, data in fetched:
+        np.testing.assert_array_equal(data, np.full(3, float(d["i"])))
+    # The slow read of the first entry doesn't hold back the others.
+    assert fetched[-1][1]["i"] == 0
+
+
+def test_fetch_cache_evicts_least_recently_used():
+    cache = FetchCache(2000)
+    for key in "abc":
+        cache.put(key, np.zeros(100))
+    assert "a" not in cache and "b" in cache and "c" in cache
+    cache.get("b")
+    cache.put("d", np.zeros(100))
+    assert "c" not in cache and "b" in cache and "d" in cache
+    assert cache.nbytes == 1600 and cache.evictions == 2
+    # Data larger than the whole cache isn't cached.
+    cache.put("e", np.zeros(1000))
+    assert "e" not in cache and "b" in cache
+
+
+@pytest.mark.parametrize("copy", [True, False])
+def test_fetch_cache_returns(tmp_path, copy):
+    p = Pact(folder_of(tmp_path), cache=FetchCache(2 ** 20, copy=copy))
+    p.store({"a": np.arange(3.0)}, "x", {"i": 0})
+    p.fetch("x", {"i": 0})
+    data = p.fetch("x", {"i": 0})
+    assert p.cache.hits == 1
+    if copy:
+        data["a"][0] = 7.0
+    else:
+        # The cached data itself is returned, and can't be modified.
+        with pytest.raises(ValueError):
+            data["a"][0] = 7.0
+    np.testing.assert_array_equal(p.fetch("x", {"i": 0})["a"], np.arange(3.0))
+
+
+def test_readonly_raises_permission_error(tmp_path):
+    folder = folder_of(tmp_path)
+    Pact(folder).store(np.arange(3.0), "a", {"i": 0})
+    files = sorted(os.listdir(folder))
+    p = Pact(folder, readonly=True)
+    np.testing.assert_array_equal(p.fetch("a", {"i": 0}), np.arange(3.0))
+    with pytest.raises(PermissionError):
+        p.store(np.arange(3.0), "a", {"i": 1})
+    with pytest.raises(PermissionError):
+        p.delete("a", {"i": 0})
+    with pytest.raises(PermissionError):
+        p.gc(0)
+    assert p.exists("a", {"i": 0})
+    assert sorted(os.listdir(folder)) == files
+
+
+def test_readonly_manifest_mismatch(tmp_path):
+    folder = folder_of(tmp_path)
+    p = Pact(folder)
+    for i in range(3):
+        p.store(np.arange(3.0), "a", {"i": i})
+    p.write_manifest()
+    p.store(np.arange(4.0), "a", {"i": 1})
+    p.store(np.arange(3.0), "a", {"i": 3})
+    p.delete("a", {"i": 2})
+    readonly = Pact(folder, readonly=True)
+    np.testing.assert_array_equal(
+        readonly.fetch("a", {"i": 0}), np.arange(3.0)
+    )
+    with pytest.raises(ValueError):
+        readonly.fetch("a", {"i": 1})
+    with pytest.raises(FileNotFoundError):
+        readonly.fetch("a", {"i": 3})
+    assert len(readonly.validate_manifest()) == 3
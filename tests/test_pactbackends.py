@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+from tntools.pact import PactBackend
+from tntools.pactbackends import MemoryPact, SQLitePact, TieredPact
+
+
+def make_backend(kind, tmp_path):
+    if kind == "memory":
+        return MemoryPact()
+    elif kind == "sqlite":
+        return SQLitePact(str(tmp_path / "db.sqlite"))
+    else:
+        return TieredPact(
+            str(tmp_path / "shared") + "/",
+            str(tmp_path / "local") + "/",
+            2 ** 20,
+        )
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite", "tiered"])
+def test_store_fetch_query_delete(tmp_path, kind):
+    p = make_backend(kind, tmp_path)
+    for i in range(3):
+        p.store({"a": np.full(4, float(i))}, "x", {"i": i, "tag": "t"})
+    assert p.exists("x", {"i": 1, "tag": "t"})
+    data = p.fetch("x", {"i": 1, "tag": "t"})
+    np.testing.assert_array_equal(data["a"], np.full(4, 1.0))
+    # Fetched arrays can be modified in place.
+    data["a"][0] = 7.0
+    assert len(p.query("x", tag="t")) == 3
+    assert p.delete("x", {"i": 1, "tag": "t"})
+    assert not p.exists("x", {"i": 1, "tag": "t"})
+    assert len(p.query("x")) == 2
+
+
+def test_tiered_truncated_copy(tmp_path):
+    p = make_backend("tiered", tmp_path)
+    p.store(np.arange(1000.0), "a", {"x": 1})
+    np.testing.assert_array_equal(p.fetch("a", {"x": 1}), np.arange(1000.0))
+    filename = p.conn.execute("SELECT filename FROM copies").fetchone()[0]
+    path = p.local_folder + filename
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        f.truncate(50)
+    np.testing.assert_array_equal(p.fetch("a", {"x": 1}), np.arange(1000.0))
+    assert os.path.getsize(path) == size
+
+
+def test_incomplete_backend_cannot_be_instantiated():
+    class NoQuery(PactBackend):
+        def exists(self, name, d, **kwargs):
+            return False
+
+        def fetch(self, name, d, lazy=False, **kwargs):
+            raise FileNotFoundError(name)
+
+        def store(self, data, name, d, cost=None, **kwargs):
+            return
+
+        def delete(self, name, d, **kwargs):
+            return False
+
+    with pytest.raises(TypeError):
+        NoQuery()
@@ -0,0 +1,83 @@
+import io
+
+import numpy as np
+import pytest
+from abeliantensors import AbelianTensor, TensorZ2
+
+from tntools import pactcodecs
+
+
+def sample_data():
+    return {
+        "floats": np.arange(12.0).reshape(3, 4),
+        "fortran": np.asfortranarray(np.arange(6.0).reshape(2, 3)),
+        "strided": np.arange(20)[::3],
+        "complex": np.array([1 + 2j, 3 - 4j]),
+        "empty": np.zeros((0, 2)),
+        "scalar": np.float64(1.5),
+        "nested": [(1, "a"), {"b": np.ones(3, dtype=np.int32)}],
+        "string": "text",
+        "none": None,
+        "tensor": TensorZ2.random(
+            shape=[[2, 3], [1, 4]], qhape=[[0, 1], [0, 1]], dirs=[1, -1]
+        ),
+    }
+
+
+def assert_same(a, b):
+    if isinstance(a, AbelianTensor):
+        assert isinstance(b, AbelianTensor)
+        assert a.shape == b.shape and a.qhape == b.qhape
+        assert a.dirs == b.dirs
+        assert a.allclose(b)
+    elif isinstance(a, np.ndarray):
+        assert a.dtype == b.dtype
+        np.testing.assert_array_equal(a, b)
+    elif isinstance(a, dict):
+        assert sorted(a.keys()) == sorted(b.keys())
+        for k in a:
+            assert_same(a[k], b[k])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_same(x, y)
+    else:
+        assert a == b
+
+
+codecs = [
+    codec
+    for codec in pactcodecs.codecs
+    if codec != "pickle5" or pactcodecs.have_pickle5
+]
+compressions = [None] + sorted(pactcodecs.compressions)
+
+
+@pytest.mark.parametrize("codec", codecs)
+@pytest.mark.parametrize("compression", compressions)
+@pytest.mark.parametrize("lazy", [False, True])
+def test_round_trip(tmp_path, codec, compression, lazy):
+    data = sample_data()
+    path = str(tmp_path / "data.p")
+    with open(path, "wb") as f:
+        pactcodecs.dump(data, f, codec, compression)
+    assert pactcodecs.detect_format(path) == (codec, compression)
+    assert_same(data, pactcodecs.load(path, lazy=lazy))
+    with open(path, "rb") as f:
+        buf = f.read()
+    assert_same(data, pactcodecs.loads(buf, lazy=lazy))
+
+
+@pytest.mark.parametrize("codec", codecs)
+def test_loaded_arrays_are_writable(codec):
+    f = io.BytesIO()
+    pactcodecs.dump({"a": np.arange(4.0)}, f, codec)
+    data = pactcodecs.loads(bytearray(f.getvalue()))
+    data["a"][0] = 7.0
+    assert data["a"][0] == 7.0
+
+
+def test_choose_codec():
+    assert pactcodecs.choose_codec({"a": np.ones(2)}) == "npy"
+    expected = "pickle5" if pactcodecs.have_pickle5 else "pickle"
+    assert pactcodecs.choose_codec({"a": 1}) == expected
@@ -0,0 +1,39 @@
+""" A setup module for datadispenser tests. T is a chain of iterations,
+where T at iter_count n is twice T at n-1, and S is the sum of T for x and
+x + 1. If record is a folder, every call of generate leaves a file there.
+"""
+
+import os
+import time
+import uuid
+
+import numpy as np
+
+parinfo = {
+    "iter_count": {"default": 0, "idfunc": lambda dataname, pars: True},
+    "x": {"default": 1.0, "idfunc": lambda dataname, pars: True},
+    "sleep": {"default": 0.0, "idfunc": lambda dataname, pars: False},
+    "record": {"default": None, "idfunc": lambda dataname, pars: False},
+}
+
+
+def prereq_pairs(dataname, pars):
+    if dataname == "S":
+        return [("T", pars.copy()), ("T", dict(pars, x=pars["x"] + 1))]
+    if pars["iter_count"] > 0:
+        return [("T", dict(pars, iter_count=pars["iter_count"] - 1))]
+    return []
+
+
+def generate(dataname, *prereqs, pars=dict(), filelogger=None):
+    if pars["record"] is not None:
+        filename = "{}_{}_{}_{}".format(
+            dataname, pars["iter_count"], pars["x"], uuid.uuid4().hex
+        )
+        open(os.path.join(pars["record"], filename), "w").close()
+    time.sleep(pars["sleep"])
+    if dataname == "S":
+        return prereqs[0] + prereqs[1]
+    if prereqs:
+        return prereqs[0] * 2
+    return np.full(3, pars["x"])